@@ -0,0 +1,57 @@
+"""Compare the default and the fast JSON path for sensordata sized results.
+
+Run with ``python bench_serialization.py [rows] [repeat]``. The default path
+mirrors what FastAPI does for a returned dict: convert rows to dicts, run
+``jsonable_encoder`` and ``json.dumps``. The fast path is
+``portal_json.encode_json`` as used for endpoints in ``PORTAL_FAST_JSON``.
+Plain dicts stand in for asyncpg records so no database is needed.
+"""
+
+import datetime
+import decimal
+import json
+import sys
+import timeit
+
+from fastapi.encoders import jsonable_encoder
+
+from portal_json import encode_json, orjson
+
+
+def make_rows(count: int) -> list[dict]:
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    return [
+        {
+            "probenumber": i % 8,
+            "sequencenumber": i,
+            "value": decimal.Decimal("21.37") + i % 100,
+            "timestamp": start + datetime.timedelta(minutes=i),
+        }
+        for i in range(count)
+    ]
+
+
+def default_path(rows: list[dict]) -> bytes:
+    body = jsonable_encoder({"result": [dict(r) for r in rows]})
+    return json.dumps(body, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode()
+
+
+def fast_path(rows: list[dict]) -> bytes:
+    return encode_json({"result": rows})
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    rows = make_rows(count)
+    print(f"rows={count} repeat={repeat} encoder={'orjson' if orjson else 'json'}")
+    results = {}
+    for name, func in (("default", default_path), ("fast", fast_path)):
+        best = min(timeit.repeat(lambda: func(rows), number=1, repeat=repeat))
+        results[name] = best
+        print(f"{name:>8}: {best * 1000:9.1f} ms  {count / best:12.0f} rows/s")
+    print(f"speedup: {results['default'] / results['fast']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""Admission control and deadlines so the API sheds load instead of queueing.
+
+Requests are split into endpoint classes, each with its own concurrency
+limit. A request that cannot get a slot within ``PORTAL_ADMISSION_WAIT``
+seconds is answered with ``503`` and ``Retry-After`` right away, instead of
+waiting behind a saturated database pool. Admitted requests run their
+statements with a per-class deadline and are cancelled, together with the
+query in flight, when the client disconnects.
+
+``PORTAL_LIMIT_HEAVY``
+    Concurrent requests to the endpoints in ``PORTAL_HEAVY_ENDPOINTS``
+    (default 8).
+``PORTAL_LIMIT_LIGHT``
+    Concurrent requests to every other ``/v1`` endpoint (default 64).
+``PORTAL_ADMISSION_WAIT``
+    Seconds a request may wait for a slot (default 0.5).
+``PORTAL_RETRY_AFTER``
+    Value of the ``Retry-After`` header in seconds (default 2).
+``PORTAL_STATEMENT_TIMEOUT_HEAVY`` / ``PORTAL_STATEMENT_TIMEOUT_LIGHT``
+    Statement deadline in seconds per endpoint class (default 60 and 10).
+``PORTAL_STATEMENT_TIMEOUTS``
+    Per endpoint overrides as ``path=seconds`` pairs separated by commas.
+"""
+
+import asyncio
+import os
+from typing import Optional
+
+from starlette.responses import JSONResponse
+
+try:
+    from .portal_db import statement_timeout
+except ImportError:  # pragma: no cover - direct execution
+    from portal_db import statement_timeout
+
+HEAVY = "heavy"
+LIGHT = "light"
+
+DEFAULT_HEAVY_ENDPOINTS = (
+    "/v1/sensorunits/data,/v1/sensorunits/data/latest,/v1/sensorunits/data/batch,"
+    "/v1/sensorunits/all,/v1/sensordata/rename"
+)
+
+
+class Overloaded(Exception):
+    """Raised when a request cannot be admitted in time."""
+
+
+class AdmissionLimiter:
+    """Per endpoint class semaphores with a bounded wait."""
+
+    def __init__(
+        self,
+        *,
+        heavy_limit: Optional[int] = None,
+        light_limit: Optional[int] = None,
+        wait: Optional[float] = None,
+        retry_after: Optional[int] = None,
+        heavy_endpoints: Optional[str] = None,
+    ) -> None:
+        self.limits = {
+            HEAVY: heavy_limit or int(os.getenv("PORTAL_LIMIT_HEAVY", "8")),
+            LIGHT: light_limit or int(os.getenv("PORTAL_LIMIT_LIGHT", "64")),
+        }
+        self.wait = wait if wait is not None else float(os.getenv("PORTAL_ADMISSION_WAIT", "0.5"))
+        self.retry_after = retry_after or int(os.getenv("PORTAL_RETRY_AFTER", "2"))
+        if heavy_endpoints is None:
+            heavy_endpoints = os.getenv("PORTAL_HEAVY_ENDPOINTS", DEFAULT_HEAVY_ENDPOINTS)
+        self.heavy_endpoints = frozenset(p.strip() for p in heavy_endpoints.split(",") if p.strip())
+        self.timeouts = {
+            HEAVY: float(os.getenv("PORTAL_STATEMENT_TIMEOUT_HEAVY", "60")),
+            LIGHT: float(os.getenv("PORTAL_STATEMENT_TIMEOUT_LIGHT", "10")),
+        }
+        self.endpoint_timeouts = {
+            path.strip(): float(seconds)
+            for path, _, seconds in (
+                item.partition("=") for item in os.getenv("PORTAL_STATEMENT_TIMEOUTS", "").split(",")
+            )
+            if path.strip() and seconds.strip()
+        }
+        self._semaphores = {name: asyncio.Semaphore(limit) for name, limit in self.limits.items()}
+        self.in_flight = {name: 0 for name in self.limits}
+        self.rejected = {name: 0 for name in self.limits}
+        self.disconnected = {name: 0 for name in self.limits}
+
+    def classify(self, path: str) -> Optional[str]:
+        """Return the endpoint class, or ``None`` for paths that are never limited."""
+        if not path.startswith("/v1/") or path.startswith("/v1/internal/"):
+            return None
+        return HEAVY if path in self.heavy_endpoints else LIGHT
+
+    def statement_timeout(self, path: str, endpoint_class: str) -> Optional[float]:
+        seconds = self.endpoint_timeouts.get(path, self.timeouts[endpoint_class])
+        return seconds if seconds > 0 else None
+
+    async def acquire(self, endpoint_class: str) -> None:
+        try:
+            await asyncio.wait_for(self._semaphores[endpoint_class].acquire(), self.wait)
+        except asyncio.TimeoutError:
+            self.rejected[endpoint_class] += 1
+            raise Overloaded(endpoint_class) from None
+        self.in_flight[endpoint_class] += 1
+
+    def release(self, endpoint_class: str) -> None:
+        self.in_flight[endpoint_class] -= 1
+        self._semaphores[endpoint_class].release()
+
+    def stats(self) -> dict:
+        return {
+            name: {
+                "limit": limit,
+                "in_flight": self.in_flight[name],
+                "rejected": self.rejected[name],
+                "disconnected": self.disconnected[name],
+            }
+            for name, limit in self.limits.items()
+        }
+
+    def overloaded_response(self, detail: str) -> JSONResponse:
+        return JSONResponse(
+            {"detail": detail},
+            status_code=503,
+            headers={"Retry-After": str(self.retry_after)},
+        )
+
+
+class AdmissionMiddleware:
+    """ASGI middleware holding an admission slot for the whole request.
+
+    The slot is held until the response body is sent, so streamed responses
+    count against the limit for as long as they run. The endpoint runs in its
+    own task with the statement deadline of its class; if the client
+    disconnects before the response is complete the task is cancelled, which
+    makes asyncpg cancel the running query and free the connection.
+    """
+
+    def __init__(self, app, limiter: AdmissionLimiter) -> None:
+        self.app = app
+        self.limiter = limiter
+
+    async def __call__(self, scope, receive, send):
+        endpoint_class = self.limiter.classify(scope["path"]) if scope["type"] == "http" else None
+        if endpoint_class is None:
+            await self.app(scope, receive, send)
+            return
+        try:
+            await self.limiter.acquire(endpoint_class)
+        except Overloaded:
+            response = self.limiter.overloaded_response("Server busy, try again later")
+            await response(scope, receive, send)
+            return
+        try:
+            with statement_timeout(self.limiter.statement_timeout(scope["path"], endpoint_class)):
+                if await self._run_until_disconnect(scope, receive, send):
+                    self.limiter.disconnected[endpoint_class] += 1
+        finally:
+            self.limiter.release(endpoint_class)
+
+    async def _run_until_disconnect(self, scope, receive, send) -> bool:
+        """Run the app; return ``True`` if it was cancelled by a disconnect."""
+        messages: asyncio.Queue = asyncio.Queue()
+        complete = False
+        disconnected = False
+
+        async def send_wrapper(message) -> None:
+            nonlocal complete
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                complete = True
+            await send(message)
+
+        app_task = asyncio.ensure_future(self.app(scope, messages.get, send_wrapper))
+
+        async def watch() -> None:
+            # Forward request messages to the app and notice the client leaving
+            nonlocal disconnected
+            while True:
+                message = await receive()
+                await messages.put(message)
+                if message["type"] == "http.disconnect":
+                    if not complete and not app_task.done():
+                        disconnected = True
+                        app_task.cancel()
+                    return
+
+        watcher = asyncio.ensure_future(watch())
+        try:
+            await app_task
+        except asyncio.CancelledError:
+            if not disconnected:
+                raise
+        finally:
+            watcher.cancel()
+        return disconnected
@@ -0,0 +1,541 @@
+"""In-process caches and their invalidation across worker processes.
+
+Results are cached per query and parameters under a namespace, normally the
+table name, so a write endpoint can drop everything derived from its table
+with :meth:`QueryCache.invalidate`. :class:`InvalidationBus` forwards such
+invalidations to every worker through Postgres ``LISTEN``/``NOTIFY``.
+
+``PORTAL_CACHE_TTL``
+    Seconds a cached result stays valid (default 300, 0 disables caching).
+``PORTAL_CACHE_SIZE``
+    Maximum number of cached results; the least recently used are evicted
+    first (default 1024).
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+from typing import Callable, Iterable, NamedTuple, Optional, Union
+
+# Namespace meaning "everything", used after missed notifications
+ALL = "*"
+
+
+class QueryCache:
+    """TTL and size bounded cache of ``fetchall`` results."""
+
+    def __init__(self, *, ttl: Optional[float] = None, max_entries: Optional[int] = None) -> None:
+        self.ttl = ttl if ttl is not None else float(os.getenv("PORTAL_CACHE_TTL", "300"))
+        self.max_entries = max_entries or int(os.getenv("PORTAL_CACHE_SIZE", "1024"))
+        self._entries: OrderedDict[tuple, tuple[float, list]] = OrderedDict()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    async def fetchall(self, db, namespace: str, query: str, params: Optional[Union[tuple, list]] = None) -> list:
+        """Return ``db.fetchall(query, params)``, cached under ``namespace``.
+
+        The returned list is shared between callers and must not be modified.
+        """
+        key = (namespace, query, tuple(params or ()))
+        entry = self._entries.get(key)
+        now = time.monotonic()
+        if entry is not None and entry[0] > now:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        generation = self._generation
+        rows = await db.fetchall(query, params)
+        # Only keep the result if no invalidation arrived while it was loading
+        if self.ttl > 0 and generation == self._generation:
+            self._entries[key] = (now + self.ttl, rows)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return rows
+
+    def invalidate(self, *namespaces: str) -> None:
+        """Drop cached results of ``namespaces``, or everything if none given."""
+        self._generation += 1
+        if not namespaces:
+            self._entries.clear()
+            return
+        for key in [key for key in self._entries if key[0] in namespaces]:
+            del self._entries[key]
+
+    def on_invalidate(self, namespace: str, keys: Optional[list] = None) -> None:
+        """:class:`InvalidationBus` handler; results are dropped per namespace."""
+        if namespace == ALL:
+            self.invalidate()
+        else:
+            self.invalidate(namespace)
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._entries),
+            "max_size": self.max_entries,
+            "ttl": self.ttl,
+        }
+
+
+class InvalidationBus:
+    """Publish cache invalidations to this and every other worker process.
+
+    :meth:`publish` runs the subscribed handlers right away and sends a
+    ``NOTIFY`` on :attr:`CHANNEL`; the other workers receive it on the
+    ``LISTEN`` connection opened by :meth:`start` and run their handlers.
+    Handlers are called once per namespace as ``handler(namespace, keys)``
+    where ``keys`` is the list of changed keys, or ``None`` for the whole
+    namespace. When the ``LISTEN`` connection had to
+    be reopened, handlers get :data:`ALL` since notifications may be lost.
+    """
+
+    CHANNEL = "portal_cache_invalidate"
+    # NOTIFY rejects payloads of 8000 bytes or more
+    MAX_PAYLOAD = 7900
+
+    def __init__(self, db) -> None:
+        self.db = db
+        self.origin = uuid.uuid4().hex
+        self._handlers: list[Callable[[str, Optional[list]], None]] = []
+
+    def subscribe(self, handler: Callable[[str, Optional[list]], None]) -> None:
+        self._handlers.append(handler)
+
+    async def start(self) -> None:
+        await self.db.listen(self.CHANNEL, self._on_notify, on_reconnect=lambda: self._dispatch([ALL], None))
+
+    async def publish(self, *namespaces: str, keys: Optional[Iterable[str]] = None) -> None:
+        """Invalidate ``namespaces`` in all workers, optionally only ``keys``.
+
+        Keys that do not fit in one ``NOTIFY`` are sent in several messages.
+        """
+        keys = list(keys) if keys is not None else None
+        self._dispatch(namespaces, keys)
+        try:
+            for payload in self._payloads(namespaces, keys):
+                await self.db.notify(self.CHANNEL, payload)
+        except Exception:
+            logging.exception("Could not publish cache invalidation for %s", namespaces)
+
+    def _payloads(self, namespaces, keys: Optional[list]) -> list[str]:
+        def encode(chunk: Optional[list]) -> str:
+            return json.dumps({"origin": self.origin, "namespaces": namespaces, "keys": chunk})
+
+        if not keys:
+            return [encode(keys)]
+        base = len(encode([]).encode())
+        if base + max(len(json.dumps(key).encode()) + 2 for key in keys) > self.MAX_PAYLOAD:
+            # A single key does not fit; drop the whole namespaces instead
+            return [encode(None)]
+        # Each key adds itself and a ", " separator
+        payloads = []
+        chunk: list = []
+        size = base
+        for key in keys:
+            key_size = len(json.dumps(key).encode()) + 2
+            if chunk and size + key_size > self.MAX_PAYLOAD:
+                payloads.append(encode(chunk))
+                chunk, size = [], base
+            chunk.append(key)
+            size += key_size
+        payloads.append(encode(chunk))
+        return payloads
+
+    def _on_notify(self, payload: str) -> None:
+        message = json.loads(payload)
+        if message.get("origin") != self.origin:
+            self._dispatch(message["namespaces"], message.get("keys"))
+
+    def _dispatch(self, namespaces, keys: Optional[list]) -> None:
+        if keys is not None and not keys:
+            return
+        for namespace in namespaces:
+            for handler in self._handlers:
+                handler(namespace, keys)
+
+
+class SensorunitInfo(NamedTuple):
+    sensorunit_id: int
+    dbname: Optional[str]
+    customer_id: Optional[int]
+    product_id: Optional[int]
+
+
+class SensorunitIndex:
+    """Serialnumber to :class:`SensorunitInfo` lookups without a round trip.
+
+    Units are loaded on first use, or all at once with :meth:`load`. Unknown
+    serialnumbers are always looked up again, so units added in another
+    worker are found right away. Subscribe :meth:`on_invalidate` to the
+    :class:`InvalidationBus`; the ``sensorunits`` namespace evicts the
+    published serialnumbers, or every unit when no keys are given.
+
+    Entries are read again after ``PORTAL_SENSORUNIT_TTL`` seconds (default
+    300), which bounds how long changes made outside this API, or a lost
+    notification, can route queries to the wrong database.
+    """
+
+    QUERY = "SELECT serialnumber, sensorunit_id, dbname, customer_id_ref, product_id_ref FROM sensorunits"
+
+    def __init__(self, db, *, ttl: Optional[float] = None) -> None:
+        self.db = db
+        self.ttl = ttl if ttl is not None else float(os.getenv("PORTAL_SENSORUNIT_TTL", "300"))
+        self._units: dict[str, tuple[float, SensorunitInfo]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _info(row) -> SensorunitInfo:
+        dbname = row["dbname"].strip() if row["dbname"] else row["dbname"]
+        return SensorunitInfo(row["sensorunit_id"], dbname, row["customer_id_ref"], row["product_id_ref"])
+
+    async def load(self) -> int:
+        """Load every sensorunit; returns the number of units."""
+        rows = await self.db.fetchall(self.QUERY, records=True)
+        expires = time.monotonic() + self.ttl
+        self._units = {row["serialnumber"]: (expires, self._info(row)) for row in rows}
+        return len(self._units)
+
+    async def get(self, serialnumber: str) -> Optional[SensorunitInfo]:
+        entry = self._units.get(serialnumber)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        row = await self.db.fetchone(self.QUERY + " WHERE serialnumber=?", (serialnumber,))
+        if row is None:
+            self._units.pop(serialnumber, None)
+            return None
+        info = self._info(row)
+        self._units[serialnumber] = (time.monotonic() + self.ttl, info)
+        return info
+
+    async def get_many(self, serialnumbers: Iterable[str]) -> dict[str, Optional[SensorunitInfo]]:
+        """Look up several units; all misses are read with one query."""
+        result: dict[str, Optional[SensorunitInfo]] = {}
+        misses = []
+        now = time.monotonic()
+        for serialnumber in serialnumbers:
+            entry = self._units.get(serialnumber)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                result[serialnumber] = entry[1]
+            else:
+                misses.append(serialnumber)
+                result[serialnumber] = None
+        if misses:
+            self.misses += len(misses)
+            rows = await self.db.fetchall(self.QUERY + " WHERE serialnumber = ANY(?)", (misses,), records=True)
+            expires = time.monotonic() + self.ttl
+            for row in rows:
+                info = self._info(row)
+                self._units[row["serialnumber"]] = (expires, info)
+                result[row["serialnumber"]] = info
+        return result
+
+    def on_invalidate(self, namespace: str, keys: Optional[list] = None) -> None:
+        if namespace == ALL or (namespace == "sensorunits" and keys is None):
+            self._units.clear()
+        elif namespace == "sensorunits":
+            for key in keys:
+                self._units.pop(key, None)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._units)}
+
+
+class UserSensorunitLists:
+    """Materialized sensorunit listing per user, refreshed row by row.
+
+    ``query`` selects one row per ``sensoraccess`` grant with a
+    ``serialnumber`` column. A user's rows are loaded on first use and kept
+    (at most ``PORTAL_USER_LIST_CACHE_SIZE`` users, default 10000, least
+    recently used dropped first). Invalidations only mark the affected
+    ``(user, serialnumber)`` rows stale; they are fetched again with one
+    query when the user's list is next requested:
+
+    * ``sensoraccess`` with ``"user_id:serialnumber"`` keys marks that grant,
+    * ``sensorunits`` with serialnumber keys marks the unit for every user,
+    * ``products`` with product id or productnumber keys marks its units,
+    * ``users`` with user id keys (deletes) drops those users' lists.
+
+    Anything broader, such as customer or helpdesk changes, drops all lists.
+    A list is loaded again in full once it is ``PORTAL_USER_LIST_TTL`` seconds
+    old (default 60), so columns written by the importer or other clients,
+    such as ``sensorunit_lastconnect``, are not served stale for long.
+    """
+
+    # Row level refresh for these namespaces when keys are given
+    ROW_NAMESPACES = ("sensoraccess", "sensorunits", "products")
+    # Changes to these tables drop every list
+    TABLES = ("customer", "customertype", "documents", "helpdesks")
+
+    def __init__(self, db, query: str, *, max_users: Optional[int] = None, ttl: Optional[float] = None) -> None:
+        self.db = db
+        self.query = query
+        self.max_users = max_users or int(os.getenv("PORTAL_USER_LIST_CACHE_SIZE", "10000"))
+        self.ttl = ttl if ttl is not None else float(os.getenv("PORTAL_USER_LIST_TTL", "60"))
+        self._lists: OrderedDict[int, dict[str, dict]] = OrderedDict()
+        self._loaded: dict[int, float] = {}
+        self._users_by_serial: dict[str, set[int]] = {}
+        self._stale: dict[int, set[str]] = {}
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.refreshed = 0
+
+    async def get(self, user_id: int) -> list[dict]:
+        rows = self._lists.get(user_id)
+        if rows is not None and self._loaded[user_id] + self.ttl <= time.monotonic():
+            self._drop(user_id)
+            rows = None
+        if rows is None:
+            self.misses += 1
+            generation = self._generation
+            loaded = time.monotonic()
+            fetched = await self.db.fetchall(self.query + " WHERE sensoraccess.user_id=?", (user_id,))
+            # Only keep the result if nothing changed while it was loading
+            if generation == self._generation:
+                self._store(user_id, fetched, loaded)
+            return fetched
+        self.hits += 1
+        self._lists.move_to_end(user_id)
+        stale = self._stale.pop(user_id, None)
+        if stale:
+            fetched = await self.db.fetchall(
+                self.query + " WHERE sensoraccess.user_id=? AND sensoraccess.serialnumber = ANY(?)",
+                (user_id, list(stale)),
+            )
+            self.refreshed += len(stale)
+            rows = self._lists.get(user_id)
+            if rows is None:
+                return fetched
+            for serial in stale:
+                if rows.pop(serial, None) is not None:
+                    self._unindex(user_id, serial)
+            for row in fetched:
+                rows[row["serialnumber"]] = row
+                self._users_by_serial.setdefault(row["serialnumber"], set()).add(user_id)
+        return list(rows.values())
+
+    def _store(self, user_id: int, fetched: list, loaded: float) -> None:
+        self._drop(user_id)
+        self._lists[user_id] = {row["serialnumber"]: row for row in fetched}
+        self._loaded[user_id] = loaded
+        for row in fetched:
+            self._users_by_serial.setdefault(row["serialnumber"], set()).add(user_id)
+        while len(self._lists) > self.max_users:
+            self._drop(next(iter(self._lists)))
+
+    def _drop(self, user_id: int) -> None:
+        for serial in self._lists.pop(user_id, {}):
+            self._unindex(user_id, serial)
+        self._stale.pop(user_id, None)
+        self._loaded.pop(user_id, None)
+
+    def _unindex(self, user_id: int, serial: str) -> None:
+        users = self._users_by_serial.get(serial)
+        if users is not None:
+            users.discard(user_id)
+            if not users:
+                del self._users_by_serial[serial]
+
+    def _mark(self, user_id: int, serial: str) -> None:
+        if user_id in self._lists:
+            self._stale.setdefault(user_id, set()).add(serial)
+
+    def clear(self) -> None:
+        self._lists.clear()
+        self._loaded.clear()
+        self._users_by_serial.clear()
+        self._stale.clear()
+
+    def on_invalidate(self, namespace: str, keys: Optional[list] = None) -> None:
+        if namespace == "users":
+            # The listing does not read users; only deleted users are dropped
+            if keys:
+                self._generation += 1
+                for key in keys:
+                    self._drop(int(key))
+            return
+        if namespace != ALL and namespace not in self.ROW_NAMESPACES and namespace not in self.TABLES:
+            return
+        self._generation += 1
+        if namespace == ALL or namespace in self.TABLES or keys is None:
+            self.clear()
+        elif namespace == "sensoraccess":
+            for key in keys:
+                user_id, _, serial = key.partition(":")
+                self._mark(int(user_id), serial)
+        elif namespace == "sensorunits":
+            for key in keys:
+                for user_id in self._users_by_serial.get(key, ()):
+                    self._mark(user_id, key)
+        elif keys:
+            products = set(keys)
+            for user_id, rows in self._lists.items():
+                for serial, row in rows.items():
+                    if str(row["product_id"]) in products or row["productnumber"] in products:
+                        self._mark(user_id, serial)
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshed_rows": self.refreshed,
+            "users": len(self._lists),
+            "max_users": self.max_users,
+        }
+
+
+class SensorAccessIndex:
+    """In-memory copy of ``sensoraccess`` indexed both ways.
+
+    Serialnumbers are interned to small integers, so each grant costs one
+    dict entry per direction: ``user_id -> {serial_id: changeallowed}`` and
+    ``serial_id -> {user_id}``. The table is loaded on first use. Subscribe
+    :meth:`on_invalidate` to the :class:`InvalidationBus`: ``sensoraccess``
+    keys of the form ``"user_id:serialnumber"`` re-read that user's grants
+    (moves publish every removed and added grant), ``sensorunits`` and
+    ``users`` keys re-read the grants of that unit or user, and anything
+    without keys reloads the whole table. Pending changes are applied before
+    the next lookup. As a backstop for grants written outside this API the
+    table is reloaded every ``PORTAL_SENSORACCESS_TTL`` seconds (default 600,
+    0 disables).
+    """
+
+    QUERY = "SELECT user_id, serialnumber, changeallowed FROM sensoraccess"
+
+    def __init__(self, db, *, ttl: Optional[float] = None) -> None:
+        self.db = db
+        self.ttl = ttl if ttl is not None else float(os.getenv("PORTAL_SENSORACCESS_TTL", "600"))
+        self._serial_ids: dict[str, int] = {}
+        self._serials: list[str] = []
+        self._by_user: dict[int, dict[int, object]] = {}
+        self._by_serial: dict[int, set[int]] = {}
+        self._pending_users: set[int] = set()
+        self._pending_serials: set[str] = set()
+        # Bumped when the whole table has to be read again
+        self._epoch = 0
+        self._loaded_epoch = -1
+        self._loaded_at = 0.0
+        self._lock = asyncio.Lock()
+        self.reloads = 0
+
+    def _intern(self, serial: str) -> int:
+        serial_id = self._serial_ids.get(serial)
+        if serial_id is None:
+            serial_id = self._serial_ids[serial] = len(self._serials)
+            self._serials.append(serial)
+        return serial_id
+
+    def _add(self, rows) -> None:
+        for row in rows:
+            serial_id = self._intern(row["serialnumber"])
+            self._by_user.setdefault(row["user_id"], {})[serial_id] = row["changeallowed"]
+            self._by_serial.setdefault(serial_id, set()).add(row["user_id"])
+
+    def _remove_user(self, user_id: int) -> None:
+        for serial_id in self._by_user.pop(user_id, {}):
+            users = self._by_serial.get(serial_id)
+            if users is not None:
+                users.discard(user_id)
+                if not users:
+                    del self._by_serial[serial_id]
+
+    def _remove_serial(self, serial: str) -> None:
+        serial_id = self._serial_ids.get(serial)
+        if serial_id is None:
+            return
+        for user_id in self._by_serial.pop(serial_id, ()):
+            grants = self._by_user.get(user_id)
+            if grants is not None:
+                grants.pop(serial_id, None)
+                if not grants:
+                    del self._by_user[user_id]
+
+    async def _sync(self) -> None:
+        if self._loaded_epoch == self._epoch and self.ttl > 0 and time.monotonic() - self._loaded_at >= self.ttl:
+            self._epoch += 1
+        if self._loaded_epoch == self._epoch and not self._pending_users and not self._pending_serials:
+            return
+        async with self._lock:
+            if self._loaded_epoch != self._epoch:
+                epoch = self._epoch
+                self._pending_users.clear()
+                self._pending_serials.clear()
+                self._loaded_at = time.monotonic()
+                rows = await self.db.fetchall(self.QUERY, records=True)
+                self._serial_ids, self._serials = {}, []
+                self._by_user, self._by_serial = {}, {}
+                self._add(rows)
+                self._loaded_epoch = epoch
+                self.reloads += 1
+            if self._pending_users:
+                users, self._pending_users = list(self._pending_users), set()
+                rows = await self.db.fetchall(self.QUERY + " WHERE user_id = ANY(?)", (users,), records=True)
+                for user_id in users:
+                    self._remove_user(user_id)
+                self._add(rows)
+            if self._pending_serials:
+                serials, self._pending_serials = list(self._pending_serials), set()
+                rows = await self.db.fetchall(self.QUERY + " WHERE serialnumber = ANY(?)", (serials,), records=True)
+                for serial in serials:
+                    self._remove_serial(serial)
+                self._add(rows)
+
+    async def access_right(self, user_id: int, serialnumber: str):
+        """Return the ``changeallowed`` value of a grant, or ``None`` without access."""
+        await self._sync()
+        serial_id = self._serial_ids.get(serialnumber)
+        if serial_id is None:
+            return None
+        return self._by_user.get(user_id, {}).get(serial_id)
+
+    async def grants_for_user(self, user_id: int) -> list[dict]:
+        await self._sync()
+        return [
+            {"serialnumber": self._serials[serial_id], "user_id": user_id, "changeallowed": allowed}
+            for serial_id, allowed in self._by_user.get(user_id, {}).items()
+        ]
+
+    async def grants_for_serial(self, serialnumber: str) -> list[dict]:
+        await self._sync()
+        serial_id = self._serial_ids.get(serialnumber)
+        if serial_id is None:
+            return []
+        return [
+            {"serialnumber": serialnumber, "user_id": user_id, "changeallowed": self._by_user[user_id][serial_id]}
+            for user_id in self._by_serial.get(serial_id, ())
+        ]
+
+    def on_invalidate(self, namespace: str, keys: Optional[list] = None) -> None:
+        if namespace not in (ALL, "sensoraccess", "sensorunits", "users"):
+            return
+        if namespace == "users" and keys is None:
+            # Adding or updating a user does not change any grant
+            return
+        if namespace == ALL or keys is None:
+            self._epoch += 1
+        elif namespace == "sensoraccess":
+            self._pending_users.update(int(key.partition(":")[0]) for key in keys)
+        elif namespace == "sensorunits":
+            self._pending_serials.update(keys)
+        else:
+            self._pending_users.update(int(key) for key in keys)
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self._by_user),
+            "serials": len(self._serials),
+            "grants": sum(len(grants) for grants in self._by_user.values()),
+            "reloads": self.reloads,
+        }
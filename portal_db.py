@@ -1,9 +1,48 @@
 """Async database helper used by the test API."""
 
+import asyncio
 import asyncpg
+import bisect
+import itertools
+import logging
 import os
 import re
-from typing import Optional, Union
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Callable, Iterable, Optional, Union
+
+_PLACEHOLDER_RE = re.compile(r"\?")
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeoutError(Exception):
+    """No pooled connection became available within the acquire timeout."""
+
+
+class StatementTimeoutError(Exception):
+    """A statement ran past its deadline and was cancelled."""
+
+
+# Deadline in seconds for each statement run in the current request
+_statement_timeout: ContextVar[Optional[float]] = ContextVar("portal_statement_timeout", default=None)
+
+
+@contextmanager
+def statement_timeout(seconds: Optional[float]):
+    """Run statements issued inside the block with an asyncpg ``timeout=``.
+
+    When a statement exceeds it, asyncpg cancels the query on the server and
+    :class:`StatementTimeoutError` is raised. ``None`` disables the deadline.
+    """
+    token = _statement_timeout.set(seconds)
+    try:
+        yield
+    finally:
+        _statement_timeout.reset(token)
+
 
 class PortalDB:
     """Simple async DB wrapper for PostgreSQL.
@@ -15,6 +54,18 @@ class PortalDB:
     You can increase the connection pool size by setting ``PORTAL_DB_POOL_SIZE``
     or passing ``max_connections`` to the constructor. This enables better
     concurrency for high traffic scenarios.
+
+    A DBI style ``dsn`` (``dbi:Pg:dbname=...``) or an explicit ``database``
+    selects the database to open; otherwise ``PORTAL_DB_NAME`` is used.
+
+    Translated queries are kept in a bounded LRU cache
+    (``PORTAL_DB_QUERY_CACHE_SIZE``, default 512) and the translated text is
+    what asyncpg keys its per-connection prepared statement cache on
+    (``PORTAL_DB_STATEMENT_CACHE_SIZE``, default 256). Repeated query shapes
+    therefore skip both the placeholder rewrite and the server-side
+    parse/plan step. See :meth:`cache_stats`.
+
+    Every statement is timed into :attr:`query_stats` (see :class:`QueryStats`).
     """
 
     def __init__(
@@ -23,72 +74,754 @@ class PortalDB:
         *,
         user: Optional[str] = None,
         password: Optional[str] = None,
+        database: Optional[str] = None,
         max_connections: Optional[int] = None,
+        max_inactive_lifetime: Optional[float] = None,
+        query_stats: Optional["QueryStats"] = None,
     ) -> None:
         # Default connection details mirror the Perl script
-        dsn = dsn or os.getenv("PORTAL_DB_DSN", "dbi:Pg:dbname=mainbase;host=localhost;port=5432")
-        user = user or os.getenv("PORTAL_DB_USER", "admin_db")
-        password = password or os.getenv("PORTAL_DB_PASS", "OnesNeser2!")
+        if database is None and dsn:
+            match = re.search(r"dbname=([^;]+)", dsn)
+            database = match.group(1).strip() if match else None
+        self.user = user or os.getenv("PORTAL_DB_USER", "admin_db")
+        self.password = password or os.getenv("PORTAL_DB_PASS", "OnesNeser2!")
+        self.database = database or os.getenv("PORTAL_DB_NAME", "mainbase")
+        self.max_connections = max_connections or int(os.getenv("PORTAL_DB_POOL_SIZE", "10"))
+        self.max_inactive_lifetime = max_inactive_lifetime
+        self.query_cache_size = int(os.getenv("PORTAL_DB_QUERY_CACHE_SIZE", "512"))
+        self.statement_cache_size = int(os.getenv("PORTAL_DB_STATEMENT_CACHE_SIZE", "256"))
+        self.stream_prefetch = int(os.getenv("PORTAL_DB_STREAM_PREFETCH", "1000"))
+        self.query_cache_hits = 0
+        self.query_cache_misses = 0
+        self._query_cache: OrderedDict[str, str] = OrderedDict()
+        self._sql_cache: dict[tuple, str] = {}
+        self.query_stats = query_stats or QueryStats()
+        timeout = float(os.getenv("PORTAL_DB_ACQUIRE_TIMEOUT", "5"))
+        self.acquire_timeout: Optional[float] = timeout if timeout > 0 else None
+        self.acquire_waiting = 0
+        self.acquire_count = 0
+        self.acquire_wait_total = 0.0
+        self.acquire_buckets = [0] * (len(QueryStats.BUCKETS_MS) + 1)
+        self.acquire_timeouts = 0
+        self._tx: ContextVar[Optional["PortalTransaction"]] = ContextVar(
+            f"portal_tx_{id(self)}", default=None
+        )
+
+        # Dedicated LISTEN connection, opened by the first call to listen()
+        self._listen_conn = None
+        self._listen_task: Optional[asyncio.Task] = None
+        self._listeners: dict[str, Callable[[str], None]] = {}
+        self._on_listen_reconnect: list[Callable[[], None]] = []
+        self._closing = False
 
         self.pool = None
 
+    def _connect_kwargs(self) -> dict:
+        return {
+            "user": self.user,
+            "password": self.password,
+            "database": self.database,
+            "host": os.getenv("PORTAL_DB_HOST", "localhost"),
+            "port": int(os.getenv("PORTAL_DB_PORT", "5432")),
+        }
+
     async def connect(self):
+        kwargs = {}
+        if self.max_inactive_lifetime is not None:
+            kwargs["max_inactive_connection_lifetime"] = self.max_inactive_lifetime
         self.pool = await asyncpg.create_pool(
-            user=os.getenv("PORTAL_DB_USER", "admin_db"),
-            password=os.getenv("PORTAL_DB_PASS", "OnesNeser2!"),
-            database=os.getenv("PORTAL_DB_NAME", "mainbase"),
-            host=os.getenv("PORTAL_DB_HOST", "localhost"),
-            port=int(os.getenv("PORTAL_DB_PORT", "5432")),
+            **self._connect_kwargs(),
             min_size=1,
-            max_size=int(os.getenv("PORTAL_DB_POOL_SIZE", "10")),
+            max_size=self.max_connections,
+            statement_cache_size=self.statement_cache_size,
+            **kwargs,
         )
 
     def _adapt_query(self, query: str) -> str:
         """Convert SQLite style '?' placeholders to asyncpg '$n' style."""
-        counter = 0
+        adapted = self._query_cache.get(query)
+        if adapted is not None:
+            self._query_cache.move_to_end(query)
+            self.query_cache_hits += 1
+            return adapted
 
-        def repl(match: re.Match) -> str:
-            nonlocal counter
-            counter += 1
-            return f"${counter}"
+        self.query_cache_misses += 1
+        counter = itertools.count(1)
+        adapted = _PLACEHOLDER_RE.sub(lambda _: f"${next(counter)}", query)
+        self._query_cache[query] = adapted
+        if len(self._query_cache) > self.query_cache_size:
+            self._query_cache.popitem(last=False)
+        return adapted
 
-        return re.sub(r"\?", repl, query)
+    def cache_stats(self) -> dict:
+        """Return hit/miss counters for the query translation cache."""
+        return {
+            "hits": self.query_cache_hits,
+            "misses": self.query_cache_misses,
+            "size": len(self._query_cache),
+            "max_size": self.query_cache_size,
+            "statement_cache_size": self.statement_cache_size,
+        }
 
-    async def execute(self, query: str, params: Optional[Union[tuple, list]] = None) -> int:
-        params = params or ()
-        query = self._adapt_query(query)
+    @asynccontextmanager
+    async def _acquire(self):
+        """Acquire a pooled connection and yield ``(conn, wait_seconds)``.
 
-        async with self.pool.acquire() as conn:
+        The wait is added to the pool's acquire histogram. Waiting longer than
+        ``acquire_timeout`` (``PORTAL_DB_ACQUIRE_TIMEOUT``, default 5 seconds,
+        0 to wait forever) raises :class:`PoolTimeoutError` and is counted in
+        ``acquire_timeouts``.
+        """
+        started = time.perf_counter()
+        self.acquire_waiting += 1
+        try:
+            conn = await self.pool.acquire(timeout=self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self.acquire_timeouts += 1
+            raise PoolTimeoutError(self.database) from None
+        finally:
+            self.acquire_waiting -= 1
+        wait = time.perf_counter() - started
+        self.acquire_count += 1
+        self.acquire_wait_total += wait
+        self.acquire_buckets[bisect.bisect_left(QueryStats.BUCKETS_MS, wait * 1000)] += 1
+        try:
+            yield conn, wait
+        finally:
+            await self.pool.release(conn)
+
+    def pool_stats(self) -> dict:
+        """Return pool saturation gauges and acquire counters."""
+        pool = self.pool
+        size = pool.get_size() if pool is not None else 0
+        idle = pool.get_idle_size() if pool is not None else 0
+        return {
+            "size": size,
+            "idle": idle,
+            "in_use": size - idle,
+            "max_size": pool.get_max_size() if pool is not None else self.max_connections,
+            "waiting": self.acquire_waiting,
+            "acquire_count": self.acquire_count,
+            "acquire_wait_seconds_total": self.acquire_wait_total,
+            "acquire_buckets": list(self.acquire_buckets),
+            "acquire_timeouts": self.acquire_timeouts,
+        }
+
+    @asynccontextmanager
+    async def _connection(self):
+        """Acquire a pooled connection for a single statement.
+
+        Yields a :class:`PortalTransaction` without opening a transaction, so the
+        statement runs in autocommit like before but is timed the same way.
+        """
+        async with self._acquire() as (conn, wait):
+            tx = PortalTransaction(self, conn, acquire_wait=wait)
             try:
-                result = await conn.execute(query, *params)
-                return result
-            except Exception as e:
+                yield tx
+            except Exception:
                 await conn.execute("ROLLBACK")
                 raise
 
+    async def execute(self, query: str, params: Optional[Union[tuple, list]] = None) -> int:
+        tx = self._tx.get()
+        if tx is not None:
+            return await tx.execute(query, params)
+        async with self._connection() as tx:
+            return await tx.execute(query, params)
+
+    async def executemany(self, query: str, params_seq: Iterable[Union[tuple, list]]) -> None:
+        """Run ``query`` once per parameter tuple in a single pipelined batch."""
+        tx = self._tx.get()
+        if tx is not None:
+            return await tx.executemany(query, params_seq)
+        async with self.transaction() as tx:
+            await tx.executemany(query, params_seq)
+
     async def fetchone(self, query: str, params: Optional[Union[tuple, list]] = None):
-        params = params or ()
-        query = self._adapt_query(query)
-        async with self.pool.acquire() as conn:
+        tx = self._tx.get()
+        if tx is not None:
+            return await tx.fetchone(query, params)
+        async with self._connection() as tx:
+            return await tx.fetchone(query, params)
+
+    async def fetchall(
+        self,
+        query: str,
+        params: Optional[Union[tuple, list]] = None,
+        *,
+        records: bool = False,
+    ):
+        """Return a list of rows as dictionaries.
+
+        With ``records=True`` the asyncpg ``Record`` objects are returned as is,
+        saving the dict conversion when the caller encodes them directly.
+        """
+        tx = self._tx.get()
+        if tx is not None:
+            return await tx.fetchall(query, params, records=records)
+        async with self._connection() as tx:
+            return await tx.fetchall(query, params, records=records)
+
+    async def stream(
+        self,
+        query: str,
+        params: Optional[Union[tuple, list]] = None,
+        *,
+        prefetch: Optional[int] = None,
+    ) -> AsyncIterator[dict]:
+        """Yield rows as dictionaries from a server-side cursor.
+
+        Rows are fetched ``prefetch`` at a time (``PORTAL_DB_STREAM_PREFETCH``,
+        default 1000), so memory use is bounded by the prefetch size rather
+        than the size of the result. The cursor runs in its own transaction on
+        a dedicated connection, or on the pinned connection when called inside
+        :meth:`transaction`.
+        """
+        prefetch = prefetch or self.stream_prefetch
+        tx = self._tx.get()
+        if tx is not None:
+            async for row in tx.stream(query, params, prefetch=prefetch):
+                yield row
+            return
+        async with self._connection() as tx:
+            async with tx.conn.transaction():
+                async for row in tx.stream(query, params, prefetch=prefetch):
+                    yield row
+
+    async def copy_records(self, table: str, columns: Iterable[str], records: list[tuple]) -> int:
+        """Bulk load ``records`` into ``table`` with ``COPY ... FROM STDIN``."""
+        tx = self._tx.get()
+        if tx is not None:
+            return await tx.copy_records(table, columns, records)
+        async with self._connection() as tx:
+            return await tx.copy_records(table, columns, records)
+
+    async def upsert(
+        self,
+        table: str,
+        key_columns: Iterable[str],
+        values: dict,
+        *,
+        insert_values: Optional[dict] = None,
+        now_columns: Iterable[str] = (),
+    ):
+        """Insert a row or update it in place with one ``INSERT ... ON CONFLICT``.
+
+        ``values`` must contain every column in ``key_columns`` and a unique
+        constraint must exist on those columns. Non-key ``values`` are written
+        on both insert and update, ``insert_values`` only when a new row is
+        created and ``now_columns`` are set to ``CURRENT_TIMESTAMP`` either way.
+        The generated SQL is cached per table and column set.
+        """
+        insert_values = insert_values or {}
+        cache_key = ("upsert", table, tuple(key_columns), tuple(values), tuple(insert_values), tuple(now_columns))
+        query = self._sql_cache.get(cache_key)
+        if query is None:
+            query = self._sql_cache[cache_key] = self._build_upsert(*cache_key[1:])
+        return await self.execute(query, (*values.values(), *insert_values.values()))
+
+    async def insert_unique(self, table: str, key_columns: Iterable[str], values: dict) -> bool:
+        """Insert a row unless one with the same ``key_columns`` exists.
+
+        Compiles to ``INSERT ... ON CONFLICT (key_columns) DO NOTHING RETURNING 1``
+        so the existence check and the insert are one race-free round trip.
+        A unique constraint must exist on ``key_columns``; without one Postgres
+        rejects the statement instead of inserting a duplicate, and clashes on
+        other unique indexes raise as usual. Returns ``True`` when the row was
+        created and ``False`` when a row with the same key already exists.
+        """
+        cache_key = ("insert_unique", table, tuple(key_columns), tuple(values))
+        query = self._sql_cache.get(cache_key)
+        if query is None:
+            query = self._sql_cache[cache_key] = (
+                f"INSERT INTO {table} ({', '.join(values)}) VALUES ({', '.join('?' * len(values))}) "
+                f"ON CONFLICT ({', '.join(cache_key[2])}) DO NOTHING RETURNING 1"
+            )
+        return await self.fetchone(query, tuple(values.values())) is not None
+
+    @staticmethod
+    def _build_upsert(table, key_columns, columns, insert_columns, now_columns) -> str:
+        names = [*columns, *insert_columns, *now_columns]
+        placeholders = ["?"] * (len(columns) + len(insert_columns))
+        placeholders += ["CURRENT_TIMESTAMP"] * len(now_columns)
+        updates = [f"{c}=EXCLUDED.{c}" for c in columns if c not in key_columns]
+        updates += [f"{c}=CURRENT_TIMESTAMP" for c in now_columns]
+        conflict = f"DO UPDATE SET {', '.join(updates)}" if updates else "DO NOTHING"
+        return (
+            f"INSERT INTO {table} ({', '.join(names)}) VALUES ({', '.join(placeholders)}) "
+            f"ON CONFLICT ({', '.join(key_columns)}) {conflict}"
+        )
+
+    @asynccontextmanager
+    async def transaction(self):
+        """Run a unit of work on one pinned connection inside one transaction.
+
+        The yielded :class:`PortalTransaction` offers the same query methods as
+        :class:`PortalDB`. While the block is active, calls made directly on
+        this ``PortalDB`` from the same task (e.g. helper functions) are routed
+        to the pinned connection as well. The transaction commits when the
+        block exits normally and rolls back if it raises. Nested use creates a
+        savepoint on the same connection.
+        """
+        tx = self._tx.get()
+        if tx is not None:
+            async with tx.conn.transaction():
+                yield tx
+            return
+
+        async with self._acquire() as (conn, wait):
+            async with conn.transaction():
+                tx = PortalTransaction(self, conn, acquire_wait=wait)
+                token = self._tx.set(tx)
+                try:
+                    yield tx
+                finally:
+                    self._tx.reset(token)
+
+    async def notify(self, channel: str, payload: str) -> None:
+        """Send ``NOTIFY`` on ``channel``; inside :meth:`transaction` it is sent on commit."""
+        await self.execute("SELECT pg_notify(?, ?)", (channel, payload))
+
+    async def listen(
+        self,
+        channel: str,
+        callback: Callable[[str], None],
+        *,
+        on_reconnect: Optional[Callable[[], None]] = None,
+    ) -> None:
+        """Call ``callback(payload)`` for every ``NOTIFY`` on ``channel``.
+
+        Notifications arrive on one dedicated connection outside the pool. If
+        that connection is lost it is reopened in the background and
+        ``on_reconnect`` is called, as notifications sent meanwhile are lost.
+        """
+        self._listeners[channel] = callback
+        if on_reconnect is not None:
+            self._on_listen_reconnect.append(on_reconnect)
+        if self._listen_conn is None:
+            await self._open_listen_conn()
+        else:
+            await self._listen_conn.add_listener(channel, self._dispatch_notify)
+
+    async def _open_listen_conn(self) -> None:
+        conn = await asyncpg.connect(**self._connect_kwargs())
+        for channel in self._listeners:
+            await conn.add_listener(channel, self._dispatch_notify)
+        conn.add_termination_listener(self._listen_terminated)
+        self._listen_conn = conn
+
+    def _dispatch_notify(self, conn, pid: int, channel: str, payload: str) -> None:
+        callback = self._listeners.get(channel)
+        if callback is not None:
             try:
-                row = await conn.fetchrow(query, *params)
-                return dict(row) if row else None
-            except Exception as e:
-                await conn.execute("ROLLBACK")
-                raise
+                callback(payload)
+            except Exception:
+                logger.exception("Notification handler for %s failed", channel)
 
-    async def fetchall(self, query: str, params: Optional[Union[tuple, list]] = None):
-        """Return a list of rows as dictionaries."""
-        params = params or ()
-        query = self._adapt_query(query)
-        async with self.pool.acquire() as conn:
+    def _listen_terminated(self, conn) -> None:
+        if conn is self._listen_conn and not self._closing:
+            self._listen_conn = None
+            self._listen_task = asyncio.ensure_future(self._reconnect_listen())
+
+    async def _reconnect_listen(self) -> None:
+        delay = 1.0
+        while not self._closing:
             try:
-                rows = await conn.fetch(query, *params)
-                return [dict(row) for row in rows]
-            except Exception as e:
-                await conn.execute("ROLLBACK")
-                raise
+                await self._open_listen_conn()
+            except (OSError, asyncpg.PostgresError) as exc:
+                logger.warning("LISTEN connection to %s failed: %s", self.database, exc)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30.0)
+                continue
+            for callback in self._on_listen_reconnect:
+                callback()
+            return
 
     async def close(self) -> None:
+        self._closing = True
+        if self._listen_task is not None:
+            self._listen_task.cancel()
+        if self._listen_conn is not None:
+            await self._listen_conn.close()
+            self._listen_conn = None
         if self.pool:
             await self.pool.close()
+
+
+class PortalTransaction:
+    """Query methods bound to the connection pinned by :meth:`PortalDB.transaction`.
+
+    Every statement is timed and recorded in the owning database's
+    :class:`QueryStats`. The pool acquire wait is attributed to the first
+    statement run on the connection. Statements use the deadline set with
+    :func:`statement_timeout`.
+    """
+
+    def __init__(self, db: PortalDB, conn, *, acquire_wait: float = 0.0) -> None:
+        self.db = db
+        self.conn = conn
+        self.acquire_wait = acquire_wait
+
+    async def _run(self, method, query: str, args: tuple, count_rows):
+        started = time.perf_counter()
+        try:
+            result = await method(self.db._adapt_query(query), *args, timeout=_statement_timeout.get())
+        except asyncio.TimeoutError:
+            self._record(query, started, None, args)
+            raise StatementTimeoutError(" ".join(query.split())) from None
+        except Exception:
+            self._record(query, started, None, args)
+            raise
+        self._record(query, started, count_rows(result), args)
+        return result
+
+    def _record(self, query: str, started: float, rows: Optional[int], params) -> None:
+        self.db.query_stats.record(
+            query, self.acquire_wait, time.perf_counter() - started, rows, params
+        )
+        self.acquire_wait = 0.0
+
+    async def execute(self, query: str, params: Optional[Union[tuple, list]] = None):
+        return await self._run(self.conn.execute, query, tuple(params or ()), _status_rowcount)
+
+    async def executemany(self, query: str, params_seq: Iterable[Union[tuple, list]]) -> None:
+        """Bind and execute ``query`` for every tuple without waiting per row."""
+        params_list = list(params_seq)
+        await self._run(self.conn.executemany, query, (params_list,), lambda _: len(params_list))
+
+    async def copy_records(self, table: str, columns: Iterable[str], records: list[tuple]) -> int:
+        columns = list(columns)
+        started = time.perf_counter()
+        statement = f"COPY {table} ({', '.join(columns)})"
+        try:
+            await self.conn.copy_records_to_table(
+                table, records=records, columns=columns, timeout=_statement_timeout.get()
+            )
+        except asyncio.TimeoutError:
+            self._record(statement, started, None, ())
+            raise StatementTimeoutError(statement) from None
+        except Exception:
+            self._record(statement, started, None, ())
+            raise
+        self._record(statement, started, len(records), ())
+        return len(records)
+
+    async def fetchone(self, query: str, params: Optional[Union[tuple, list]] = None):
+        row = await self._run(self.conn.fetchrow, query, tuple(params or ()), lambda r: int(r is not None))
+        return dict(row) if row else None
+
+    async def fetchall(
+        self,
+        query: str,
+        params: Optional[Union[tuple, list]] = None,
+        *,
+        records: bool = False,
+    ):
+        rows = await self._run(self.conn.fetch, query, tuple(params or ()), len)
+        return rows if records else [dict(row) for row in rows]
+
+    async def stream(
+        self,
+        query: str,
+        params: Optional[Union[tuple, list]] = None,
+        *,
+        prefetch: int,
+    ) -> AsyncIterator[dict]:
+        """Iterate a server-side cursor; must run inside a transaction."""
+        params = tuple(params or ())
+        started = time.perf_counter()
+        count = 0
+        failed = False
+        try:
+            cursor = self.conn.cursor(
+                self.db._adapt_query(query), *params, prefetch=prefetch, timeout=_statement_timeout.get()
+            )
+            async for record in cursor:
+                count += 1
+                yield dict(record)
+        except asyncio.TimeoutError:
+            failed = True
+            raise StatementTimeoutError(" ".join(query.split())) from None
+        except Exception:
+            failed = True
+            raise
+        finally:
+            # Also recorded when the consumer stops early, e.g. a client disconnect
+            self._record(query, started, None if failed else count, params)
+
+
+def _status_rowcount(status: str) -> int:
+    """Return the row count from a command status such as ``UPDATE 3``."""
+    last = status.rsplit(" ", 1)[-1] if status else ""
+    return int(last) if last.isdigit() else 0
+
+
+class QueryStats:
+    """Latency histograms and slow-query logging per normalized statement.
+
+    For every statement the pool acquire wait, execution time and number of
+    rows are aggregated under the statement text with whitespace collapsed.
+    Statements taking longer than ``PORTAL_DB_SLOW_QUERY_MS`` (default 500)
+    are logged with their parameters redacted to types only. At most
+    ``PORTAL_DB_QUERY_STATS_SIZE`` (default 500) distinct statements are
+    tracked; further ones are counted under ``<other>``.
+    """
+
+    BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self, *, slow_ms: Optional[float] = None, max_statements: Optional[int] = None) -> None:
+        self.slow_ms = slow_ms if slow_ms is not None else float(os.getenv("PORTAL_DB_SLOW_QUERY_MS", "500"))
+        self.max_statements = max_statements or int(os.getenv("PORTAL_DB_QUERY_STATS_SIZE", "500"))
+        self._statements: dict[str, _StatementStats] = {}
+        self._normalized: dict[str, str] = {}
+
+    def _key(self, query: str) -> str:
+        key = self._normalized.get(query)
+        if key is None:
+            key = " ".join(query.split())
+            if key not in self._statements and len(self._statements) >= self.max_statements:
+                key = "<other>"
+            elif len(self._normalized) < self.max_statements * 4:
+                self._normalized[query] = key
+        return key
+
+    def record(
+        self,
+        query: str,
+        acquire_wait: float,
+        elapsed: float,
+        rows: Optional[int],
+        params=(),
+    ) -> None:
+        """Add one execution; ``rows`` is ``None`` when the statement failed."""
+        key = self._key(query)
+        stats = self._statements.get(key)
+        if stats is None:
+            stats = self._statements[key] = _StatementStats(len(self.BUCKETS_MS) + 1)
+        acquire_ms = acquire_wait * 1000
+        exec_ms = elapsed * 1000
+        stats.add(acquire_ms, exec_ms, rows, self.BUCKETS_MS)
+        if exec_ms + acquire_ms >= self.slow_ms:
+            logger.warning(
+                "Slow query %.1f ms (acquire %.1f ms, rows %s): %s params=%s",
+                exec_ms,
+                acquire_ms,
+                "error" if rows is None else rows,
+                key,
+                redact_params(params),
+            )
+
+    def snapshot(self) -> dict:
+        """Return the aggregates, slowest total execution time first."""
+        statements = sorted(
+            self._statements.items(), key=lambda item: item[1].exec_ms_total, reverse=True
+        )
+        return {
+            "buckets_ms": list(self.BUCKETS_MS) + ["+Inf"],
+            "statements": [{"statement": key, **stats.as_dict()} for key, stats in statements],
+        }
+
+    def reset(self) -> None:
+        self._statements.clear()
+
+
+class _StatementStats:
+    __slots__ = (
+        "count",
+        "errors",
+        "rows",
+        "exec_ms_total",
+        "exec_ms_max",
+        "acquire_ms_total",
+        "acquire_ms_max",
+        "exec_buckets",
+        "acquire_buckets",
+    )
+
+    def __init__(self, buckets: int) -> None:
+        self.count = 0
+        self.errors = 0
+        self.rows = 0
+        self.exec_ms_total = 0.0
+        self.exec_ms_max = 0.0
+        self.acquire_ms_total = 0.0
+        self.acquire_ms_max = 0.0
+        self.exec_buckets = [0] * buckets
+        self.acquire_buckets = [0] * buckets
+
+    def add(self, acquire_ms: float, exec_ms: float, rows: Optional[int], bounds) -> None:
+        self.count += 1
+        if rows is None:
+            self.errors += 1
+        else:
+            self.rows += rows
+        self.exec_ms_total += exec_ms
+        self.exec_ms_max = max(self.exec_ms_max, exec_ms)
+        self.acquire_ms_total += acquire_ms
+        self.acquire_ms_max = max(self.acquire_ms_max, acquire_ms)
+        self.exec_buckets[bisect.bisect_left(bounds, exec_ms)] += 1
+        self.acquire_buckets[bisect.bisect_left(bounds, acquire_ms)] += 1
+
+    def as_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+def redact_params(params) -> str:
+    """Describe query parameters by type only so values never reach the log."""
+    return "[" + ", ".join(type(p).__name__ for p in params or ()) + "]"
+
+
+class PortalDBRegistry:
+    """Long-lived :class:`PortalDB` pools keyed by database name.
+
+    Sensordata is stored in one database per customer (``sensorunits.dbname``).
+    Instead of opening and closing a pool for every request the registry keeps
+    one pool per database alive and hands it out through :meth:`lease`.
+
+    Limits are read from the environment unless passed explicitly:
+
+    ``PORTAL_SENSORDB_POOL_SIZE``
+        Maximum connections per customer pool (default 5).
+    ``PORTAL_SENSORDB_IDLE_TIMEOUT``
+        Seconds a pool may stay unused before it is closed (default 300).
+    ``PORTAL_SENSORDB_MAX_CONNECTIONS``
+        Ceiling for the sum of all customer pool sizes (default 50). When a new
+        pool would exceed it, the least recently used idle pools are closed;
+        if every pool is leased, :meth:`lease` waits for one to be released.
+    ``PORTAL_DB_ACQUIRE_TIMEOUT``
+        Seconds :meth:`lease` waits for room under the ceiling before raising
+        :class:`PoolTimeoutError` (default 5, ``0`` waits indefinitely).
+
+    Pools are opened without blocking leases of other databases; concurrent
+    leases of a database that is still connecting share one connect.
+    """
+
+    def __init__(
+        self,
+        *,
+        pool_size: Optional[int] = None,
+        idle_timeout: Optional[float] = None,
+        max_connections: Optional[int] = None,
+        acquire_timeout: Optional[float] = None,
+    ) -> None:
+        self.pool_size = pool_size or int(os.getenv("PORTAL_SENSORDB_POOL_SIZE", "5"))
+        self.idle_timeout = idle_timeout or float(os.getenv("PORTAL_SENSORDB_IDLE_TIMEOUT", "300"))
+        self.max_connections = max_connections or int(os.getenv("PORTAL_SENSORDB_MAX_CONNECTIONS", "50"))
+        self.pool_size = min(self.pool_size, self.max_connections)
+        if acquire_timeout is None:
+            acquire_timeout = float(os.getenv("PORTAL_DB_ACQUIRE_TIMEOUT", "5"))
+        self.acquire_timeout: Optional[float] = acquire_timeout if acquire_timeout > 0 else None
+        # One set of statement statistics for all customer databases
+        self.query_stats = QueryStats()
+        self._dbs: dict[str, PortalDB] = {}
+        self._opening: dict[str, asyncio.Task] = {}
+        self._last_used: dict[str, float] = {}
+        self._leases: dict[str, int] = {}
+        # Set whenever a pool becomes idle or a slot under the ceiling frees up
+        self._released = asyncio.Event()
+
+    @asynccontextmanager
+    async def lease(self, dbname: str):
+        """Yield the :class:`PortalDB` for ``dbname``, opening it if needed.
+
+        A leased pool is never evicted, so callers may use it freely until the
+        ``async with`` block ends.
+        """
+        dbname = dbname.strip()
+        db = await self._get(dbname)
+        try:
+            yield db
+        finally:
+            self._leases[dbname] -= 1
+            self._last_used[dbname] = time.monotonic()
+            if self._leases[dbname] == 0:
+                self._released.set()
+
+    async def _get(self, dbname: str) -> PortalDB:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.acquire_timeout if self.acquire_timeout is not None else None
+        while True:
+            db = self._dbs.get(dbname)
+            if db is not None:
+                self._leases[dbname] += 1
+                self._last_used[dbname] = time.monotonic()
+                return db
+            opening = self._opening.get(dbname)
+            if opening is None:
+                closing = self._evict_idle(time.monotonic())
+                if not self._has_room():
+                    closing += self._make_room(self.pool_size)
+                if self._has_room():
+                    opening = self._opening[dbname] = asyncio.ensure_future(self._open(dbname, closing))
+                else:
+                    # Cleared before any await so a release in the meantime is not lost
+                    self._released.clear()
+                    for idle in closing:
+                        await idle.close()
+            if opening is not None:
+                # Shielded so a cancelled lease does not abort a connect others wait for
+                await asyncio.shield(opening)
+                continue
+            timeout = deadline - loop.time() if deadline is not None else None
+            if timeout is not None and timeout <= 0:
+                raise PoolTimeoutError(dbname)
+            try:
+                await asyncio.wait_for(self._released.wait(), timeout)
+            except asyncio.TimeoutError:
+                raise PoolTimeoutError(dbname) from None
+
+    async def _open(self, dbname: str, closing: list["PortalDB"]) -> None:
+        try:
+            for idle in closing:
+                await idle.close()
+            db = PortalDB(
+                database=dbname,
+                max_connections=self.pool_size,
+                max_inactive_lifetime=self.idle_timeout,
+                query_stats=self.query_stats,
+            )
+            await db.connect()
+            self._dbs[dbname] = db
+            self._leases[dbname] = 0
+            self._last_used[dbname] = time.monotonic()
+        finally:
+            del self._opening[dbname]
+            self._released.set()
+
+    def _has_room(self) -> bool:
+        return (len(self._dbs) + len(self._opening) + 1) * self.pool_size <= self.max_connections
+
+    def _evict_idle(self, now: float) -> list["PortalDB"]:
+        """Remove pools unused for ``idle_timeout`` seconds; the caller closes them."""
+        idle = [
+            name for name in self._dbs
+            if self._leases[name] == 0 and now - self._last_used[name] > self.idle_timeout
+        ]
+        return [self._remove(name) for name in idle]
+
+    def _make_room(self, needed: int) -> list["PortalDB"]:
+        """Remove least recently used idle pools until ``needed`` connections fit."""
+        candidates = sorted(
+            (name for name in self._dbs if self._leases[name] == 0),
+            key=self._last_used.__getitem__,
+        )
+        removed = []
+        while candidates and (len(self._dbs) + len(self._opening)) * self.pool_size + needed > self.max_connections:
+            removed.append(self._remove(candidates.pop(0)))
+        return removed
+
+    def _remove(self, dbname: str) -> "PortalDB":
+        db = self._dbs.pop(dbname)
+        self._last_used.pop(dbname, None)
+        self._leases.pop(dbname, None)
+        return db
+
+    def pool_stats(self) -> dict[str, dict]:
+        """Return :meth:`PortalDB.pool_stats` for every open customer pool."""
+        return {name: db.pool_stats() for name, db in self._dbs.items()}
+
+    async def close(self) -> None:
+        for task in list(self._opening.values()):
+            task.cancel()
+        for name in list(self._dbs):
+            await self._remove(name).close()
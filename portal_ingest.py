@@ -0,0 +1,258 @@
+"""Optional in-process ingestion of sensordata into the customer databases.
+
+``/v1/sensordata/add`` normally leaves a file for the external importer.
+With ``PORTAL_INGEST_PIPELINE=1`` readings are instead queued here; a worker
+groups them by the unit's ``dbname``, loads each group into that customer's
+``sensordata`` table with ``COPY`` and updates ``sensorslatestvalues`` in the
+main database with one batched upsert per flush.
+
+``PORTAL_INGEST_QUEUE_SIZE``
+    Readings that may wait in the queue (default 10000); when it is full
+    :meth:`IngestPipeline.submit` raises :class:`IngestQueueFull`.
+``PORTAL_INGEST_BATCH``
+    Maximum readings per flush (default 2000).
+``PORTAL_INGEST_INTERVAL``
+    Seconds to wait for more readings before flushing (default 0.5).
+
+Readings that cannot be written are handed to the fallback spool, so the
+importer still picks them up. With NumPy installed each flush is parsed as
+one block by :mod:`portal_sensordata`.
+"""
+
+import asyncio
+import datetime
+import logging
+import math
+import os
+from typing import Awaitable, Callable, NamedTuple, Optional
+
+try:
+    from .portal_sensordata import latest_per_probe, numpy, parse_block
+    from .portal_spool import format_line
+except ImportError:  # pragma: no cover - direct execution
+    from portal_sensordata import latest_per_probe, numpy, parse_block
+    from portal_spool import format_line
+
+SENSORDATA_COLUMNS = ("serialnumber", "probenumber", "sequencenumber", "value", "timestamp")
+
+# Only move the latest value forward, readings may arrive out of order
+LATEST_UPSERT = (
+    "INSERT INTO sensorslatestvalues (serialnumber, probenumber, value, timestamp) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT (serialnumber, probenumber) DO UPDATE SET value=EXCLUDED.value, timestamp=EXCLUDED.timestamp "
+    "WHERE sensorslatestvalues.timestamp < EXCLUDED.timestamp"
+)
+
+
+class IngestQueueFull(Exception):
+    """The ingestion queue is full; the client should retry later."""
+
+
+class Reading(NamedTuple):
+    timestamp: int
+    serialnumber: str
+    sensordata: str
+    packagecounter: int
+
+
+def parse_sensordata(sensordata: str) -> list[tuple[int, float]]:
+    """Return ``(probenumber, value)`` pairs from a comma separated value list.
+
+    Probes are numbered from 1 in the order of the values. Empty fields mean
+    the probe has no value and are skipped. Raises ``ValueError`` for values
+    that are not finite numbers.
+    """
+    pairs = []
+    for probenumber, field in enumerate(sensordata.split(","), start=1):
+        field = field.strip()
+        if field:
+            value = float(field)
+            if not math.isfinite(value):
+                raise ValueError(f"value is not finite: {field}")
+            pairs.append((probenumber, value))
+    return pairs
+
+
+class IngestPipeline:
+    """Bounded queue and background worker writing readings in batches."""
+
+    def __init__(
+        self,
+        db,
+        sensordbs,
+        resolve: Callable[[str], Awaitable],
+        *,
+        fallback=None,
+        queue_size: Optional[int] = None,
+        batch: Optional[int] = None,
+        interval: Optional[float] = None,
+    ) -> None:
+        self.db = db
+        self.sensordbs = sensordbs
+        self.resolve = resolve
+        self.fallback = fallback
+        self.batch = batch or int(os.getenv("PORTAL_INGEST_BATCH", "2000"))
+        self.interval = interval if interval is not None else float(os.getenv("PORTAL_INGEST_INTERVAL", "0.5"))
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size or int(os.getenv("PORTAL_INGEST_QUEUE_SIZE", "10000")))
+        self._worker: Optional[asyncio.Task] = None
+        self._accepting = False
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.flushes = 0
+
+    def start(self) -> None:
+        self._accepting = True
+        self._worker = asyncio.ensure_future(self._run())
+
+    def submit(self, reading: Reading) -> None:
+        if not self._accepting:
+            raise IngestQueueFull("pipeline is not running")
+        try:
+            self.queue.put_nowait(reading)
+        except asyncio.QueueFull:
+            raise IngestQueueFull("ingestion queue is full") from None
+
+    async def close(self) -> None:
+        """Stop accepting readings and flush everything still queued."""
+        if self._worker is None:
+            return
+        self._accepting = False
+        await self.queue.put(None)
+        await self._worker
+        self._worker = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item is None:
+                break
+            readings = [item]
+            deadline = loop.time() + self.interval
+            while len(readings) < self.batch:
+                try:
+                    item = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if item is None:
+                    stopping = True
+                    break
+                readings.append(item)
+            try:
+                await self.flush(readings)
+            except Exception:
+                logging.exception("Sensordata flush of %d readings failed", len(readings))
+                self.failed += len(readings)
+                await self._to_fallback(readings)
+
+    async def flush(self, readings: list[Reading]) -> None:
+        """Write ``readings`` to the customer databases and the latest values."""
+        self.flushes += 1
+        if numpy is not None:
+            groups, grouped, latest = await self._prepare_block(readings)
+        else:
+            groups, grouped, latest = await self._prepare(readings)
+        for dbname, rows in groups.items():
+            try:
+                async with self.sensordbs.lease(dbname) as sensordb:
+                    await sensordb.copy_records("sensordata", SENSORDATA_COLUMNS, rows)
+                self.written += len(rows)
+            except Exception:
+                logging.exception("COPY of %d sensordata rows into %s failed", len(rows), dbname)
+                self.failed += len(grouped[dbname])
+                await self._to_fallback(grouped[dbname])
+        if latest:
+            try:
+                await self.db.executemany(LATEST_UPSERT, latest)
+            except Exception:
+                # The rows are in sensordata already; spooling them again would duplicate them
+                logging.exception("Update of %d sensorslatestvalues failed", len(latest))
+
+    async def _prepare(self, readings: list[Reading]):
+        """Group rows per ``dbname`` and pick the latest value per probe."""
+        groups: dict[str, list[tuple]] = {}
+        grouped: dict[str, list[Reading]] = {}
+        latest: dict[tuple[str, int], tuple] = {}
+        for reading in readings:
+            unit = await self.resolve(reading.serialnumber)
+            if unit is None or not unit.dbname:
+                logging.warning("Dropped sensordata for unknown serialnumber:%s", reading.serialnumber)
+                self.dropped += 1
+                continue
+            try:
+                values = parse_sensordata(reading.sensordata)
+            except ValueError:
+                logging.warning("Dropped malformed sensordata for %s: %s", reading.serialnumber, reading.sensordata)
+                self.dropped += 1
+                continue
+            # Naive UTC, like the timestamps the importer writes
+            stamp = datetime.datetime.fromtimestamp(reading.timestamp, datetime.timezone.utc).replace(tzinfo=None)
+            grouped.setdefault(unit.dbname, []).append(reading)
+            rows = groups.setdefault(unit.dbname, [])
+            for probenumber, value in values:
+                rows.append((reading.serialnumber, probenumber, reading.packagecounter, value, stamp))
+                key = (reading.serialnumber, probenumber)
+                if key not in latest or latest[key][3] <= stamp:
+                    latest[key] = (reading.serialnumber, probenumber, value, stamp)
+        return groups, grouped, list(latest.values())
+
+    async def _prepare_block(self, readings: list[Reading]):
+        """Vectorized :meth:`_prepare` using :func:`portal_sensordata.parse_block`."""
+        block = parse_block([format_line(*reading) for reading in readings])
+        for number, reason in block.errors:
+            logging.warning("Dropped malformed sensordata (%s): %s", reason, readings[number].sensordata)
+        self.dropped += len(block.errors)
+        dbnames: list[str] = []
+        unit_db = numpy.full(len(block.serials), -1, dtype=numpy.int64)
+        for index, serial in enumerate(block.serials):
+            unit = await self.resolve(serial)
+            if unit is None or not unit.dbname:
+                logging.warning("Dropped sensordata for unknown serialnumber:%s", serial)
+                self.dropped += int(numpy.unique(block.line[block.unit == index]).size)
+                continue
+            if unit.dbname not in dbnames:
+                dbnames.append(unit.dbname)
+            unit_db[index] = dbnames.index(unit.dbname)
+        value_db = unit_db[block.unit]
+        # datetime64[s] converts to naive UTC datetimes
+        stamps = block.timestamp.astype("datetime64[s]").tolist()
+        serials = [block.serials[u] for u in block.unit.tolist()]
+        columns = (serials, block.probenumber.tolist(), block.packagecounter.tolist(), block.value.tolist(), stamps)
+        rows = list(zip(*columns))
+        groups: dict[str, list[tuple]] = {}
+        grouped: dict[str, list[Reading]] = {}
+        for db_index, dbname in enumerate(dbnames):
+            selected = numpy.flatnonzero(value_db == db_index)
+            groups[dbname] = [rows[i] for i in selected.tolist()]
+            grouped[dbname] = [readings[i] for i in numpy.unique(block.line[selected]).tolist()]
+        latest = [
+            (serials[i], columns[1][i], columns[3][i], stamps[i])
+            for i in latest_per_probe(block).tolist()
+            if value_db[i] >= 0
+        ]
+        return groups, grouped, latest
+
+    async def _to_fallback(self, readings: list[Reading]) -> None:
+        if self.fallback is None or not readings:
+            return
+        try:
+            await self.fallback.append(format_line(*reading) for reading in readings)
+        except Exception:
+            logging.exception("Could not spool %d sensordata readings", len(readings))
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queue.qsize(),
+            "max_queue": self.queue.maxsize,
+            "written_rows": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "flushes": self.flushes,
+        }
@@ -0,0 +1,134 @@
+"""JSON encoding helpers for the API responses.
+
+``orjson`` is used when it is installed and the standard ``json`` module
+otherwise, so the API runs either way.
+"""
+
+import calendar
+import datetime
+import decimal
+import json
+import logging
+from typing import AsyncIterator, Callable, Iterable, Optional
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+STREAM_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "json": "application/json"}
+
+
+def json_default(value):
+    """Encode values asyncpg returns that ``json`` does not handle."""
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if hasattr(value, "items"):
+        # asyncpg.Record and other mappings
+        return dict(value.items())
+    return str(value)
+
+
+def _orjson_default(value):
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if hasattr(value, "items"):
+        return dict(value.items())
+    return str(value)
+
+
+def epoch_seconds(value: datetime.datetime) -> int:
+    """Return Unix seconds; naive timestamps are taken as UTC like Postgres does."""
+    if value.tzinfo is None:
+        return calendar.timegm(value.timetuple())
+    return int(value.timestamp())
+
+
+def columnar(rows, columns: Iterable[str], epoch_columns: Iterable[str] = ()) -> dict:
+    """Turn ``rows`` into one list per column.
+
+    Columns in ``epoch_columns`` are converted to Unix seconds so charting
+    code can use them without parsing dates.
+    """
+    epoch_columns = set(epoch_columns)
+    result = {}
+    for column in columns:
+        values = [row[column] for row in rows]
+        if column in epoch_columns:
+            values = [epoch_seconds(v) if v is not None else None for v in values]
+        result[column] = values
+    return result
+
+
+def encode_json(data) -> bytes:
+    """Encode ``data`` straight to bytes.
+
+    ``data`` may contain asyncpg records, datetimes and decimals; no
+    intermediate ``jsonable_encoder`` pass is needed.
+    """
+    if orjson is not None:
+        return orjson.dumps(data, default=_orjson_default)
+    return json.dumps(data, default=json_default, separators=(",", ":")).encode()
+
+
+async def stream_json_rows(rows: AsyncIterator[dict], fmt: str, batch: int = 500) -> AsyncIterator[str]:
+    """Encode ``rows`` as NDJSON or as a chunked ``{"result": [...]}`` document.
+
+    Rows are encoded ``batch`` at a time so each chunk written to the client
+    is reasonably sized. If ``rows`` fails part way, the output ends with an
+    ``{"error": ...}`` line (NDJSON) or an ``"error"`` field after the result,
+    so a truncated result is not mistaken for a complete one.
+    """
+    chunk: list[str] = []
+    first = True
+    if fmt == "json":
+        yield '{"result":['
+    try:
+        async for row in rows:
+            chunk.append(json.dumps(row, default=json_default))
+            if len(chunk) >= batch:
+                yield _join_chunk(chunk, fmt, first)
+                first = False
+                chunk = []
+    except Exception:
+        # The status line is already sent; end with an error the client can see
+        logging.exception("Streaming rows failed")
+        if chunk:
+            yield _join_chunk(chunk, fmt, first)
+        yield '{"error":"Stream aborted"}\n' if fmt == "ndjson" else '],"error":"Stream aborted"}'
+        return
+    if chunk:
+        yield _join_chunk(chunk, fmt, first)
+    if fmt == "json":
+        yield "]}"
+
+
+async def stream_json_object(
+    items: AsyncIterator[tuple[str, object]],
+    head: Optional[dict] = None,
+    tail: Optional[Callable[[], dict]] = None,
+) -> AsyncIterator[bytes]:
+    """Encode ``{**head, "result": {key: value, ...}, **tail()}`` one item at a time.
+
+    Each ``(key, value)`` pair is written as soon as ``items`` yields it, so
+    the client receives results in the order they become available. ``tail``
+    is called after the last item, for fields only known at the end.
+    """
+    def fields(values: dict) -> bytes:
+        return b"".join(encode_json(key) + b":" + encode_json(value) + b"," for key, value in values.items())
+
+    yield b"{" + fields(head or {}) + b'"result":{'
+    first = True
+    async for key, value in items:
+        yield (b"" if first else b",") + encode_json(key) + b":" + encode_json(value)
+        first = False
+    trailer = fields(tail()) if tail is not None else b""
+    yield b"}" + (b"," + trailer[:-1] if trailer else b"") + b"}"
+
+
+def _join_chunk(chunk: list[str], fmt: str, first: bool) -> str:
+    if fmt == "ndjson":
+        return "\n".join(chunk) + "\n"
+    return ("" if first else ",") + ",".join(chunk)
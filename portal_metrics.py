@@ -0,0 +1,68 @@
+"""Prometheus text exposition for the database pools and admission control.
+
+Only the text format is produced, so no client library is needed. Each pool
+is labelled ``pool="mainbase"`` or with the customer database name.
+"""
+
+from typing import Iterable, Mapping
+
+try:
+    from .portal_db import QueryStats
+except ImportError:  # pragma: no cover - direct execution
+    from portal_db import QueryStats
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_GAUGES = (
+    ("portal_db_pool_connections_in_use", "in_use", "Connections checked out of the pool."),
+    ("portal_db_pool_connections_idle", "idle", "Open connections not in use."),
+    ("portal_db_pool_connections_max", "max_size", "Configured maximum pool size."),
+    ("portal_db_pool_acquire_waiting", "waiting", "Requests currently waiting for a connection."),
+)
+
+
+def _label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_pool_metrics(pools: Iterable[tuple[str, Mapping]]) -> str:
+    """Render ``(name, PortalDB.pool_stats())`` pairs as Prometheus text."""
+    pools = [(_label(name), stats) for name, stats in pools]
+    lines: list[str] = []
+    for metric, key, help_text in _GAUGES:
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} gauge")
+        lines.extend(f'{metric}{{pool="{name}"}} {stats[key]}' for name, stats in pools)
+
+    metric = "portal_db_pool_acquire_wait_seconds"
+    lines.append(f"# HELP {metric} Time spent waiting for a pooled connection.")
+    lines.append(f"# TYPE {metric} histogram")
+    bounds = [str(ms / 1000) for ms in QueryStats.BUCKETS_MS] + ["+Inf"]
+    for name, stats in pools:
+        cumulative = 0
+        for bound, count in zip(bounds, stats["acquire_buckets"]):
+            cumulative += count
+            lines.append(f'{metric}_bucket{{pool="{name}",le="{bound}"}} {cumulative}')
+        lines.append(f'{metric}_sum{{pool="{name}"}} {stats["acquire_wait_seconds_total"]}')
+        lines.append(f'{metric}_count{{pool="{name}"}} {stats["acquire_count"]}')
+
+    metric = "portal_db_pool_acquire_timeouts_total"
+    lines.append(f"# HELP {metric} Acquires that gave up after PORTAL_DB_ACQUIRE_TIMEOUT.")
+    lines.append(f"# TYPE {metric} counter")
+    lines.extend(f'{metric}{{pool="{name}"}} {stats["acquire_timeouts"]}' for name, stats in pools)
+    return "\n".join(lines) + "\n"
+
+
+def render_admission_metrics(stats: Mapping[str, Mapping]) -> str:
+    """Render :meth:`AdmissionLimiter.stats` as Prometheus text."""
+    lines: list[str] = []
+    for metric, key, kind, help_text in (
+        ("portal_admission_limit", "limit", "gauge", "Concurrent requests allowed per endpoint class."),
+        ("portal_admission_in_flight", "in_flight", "gauge", "Requests currently admitted."),
+        ("portal_admission_rejected_total", "rejected", "counter", "Requests answered with 503."),
+        ("portal_admission_disconnected_total", "disconnected", "counter", "Requests cancelled after the client disconnected."),
+    ):
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} {kind}")
+        lines.extend(f'{metric}{{class="{name}"}} {values[key]}' for name, values in stats.items())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,159 @@
+"""Vectorized parsing of sensordata lines into NumPy arrays.
+
+A block of ``timestamp,serialnumber,v1,v2,...,packagecounter`` lines, the
+format of the spool and of ``/v1/sensordata/add``, becomes one flat set of
+arrays with an entry per probe value. Lines are split in Python, but value
+conversion, probe numbering and selection run on whole arrays, which keeps
+the cost per value low for large blocks.
+
+``numpy`` is optional; :data:`numpy` is ``None`` when it is not installed and
+callers fall back to :func:`portal_ingest.parse_sensordata`.
+
+:func:`lttb` downsamples a series for charts and needs no NumPy.
+"""
+
+from typing import NamedTuple, Sequence
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover - optional dependency
+    numpy = None
+
+
+class SensordataBlock(NamedTuple):
+    """Parsed values; all arrays have one entry per probe value."""
+
+    serials: list  # distinct serialnumbers, indexed by ``unit``
+    line: "numpy.ndarray"  # index of the source line
+    unit: "numpy.ndarray"  # index into ``serials``
+    timestamp: "numpy.ndarray"  # epoch seconds, int64
+    packagecounter: "numpy.ndarray"  # int64
+    probenumber: "numpy.ndarray"  # from 1, in field order
+    value: "numpy.ndarray"  # float64
+    errors: list  # ``(line index, reason)`` for rejected lines
+
+
+def parse_block(lines: Sequence[str]) -> SensordataBlock:
+    """Parse ``lines`` into a :class:`SensordataBlock`.
+
+    Empty value fields are skipped but still count for the probe number.
+    Lines with a missing serialnumber, a timestamp or packagecounter that is
+    not an integer, or any value that is not a finite number are left out and
+    reported in ``errors``; their serialnumbers are not added to ``serials``.
+    """
+    if numpy is None:
+        raise RuntimeError("parse_block needs numpy")
+    errors: list[tuple[int, str]] = []
+    fields: list[str] = []
+    counts: list[int] = []
+    line_serials: list[str] = []
+    stamps: list[int] = []
+    counters: list[int] = []
+    for number, text in enumerate(lines):
+        parts = text.split(",")
+        serial = parts[1].strip() if len(parts) >= 4 else ""
+        try:
+            stamp = int(parts[0])
+            counter = int(parts[-1])
+        except ValueError:
+            serial = ""
+        if not serial:
+            errors.append((number, "malformed line"))
+            counts.append(0)
+            line_serials.append("")
+            stamps.append(0)
+            counters.append(0)
+            continue
+        values = parts[2:-1]
+        fields.extend(values)
+        counts.append(len(values))
+        line_serials.append(serial)
+        stamps.append(stamp)
+        counters.append(counter)
+
+    counts_array = numpy.asarray(counts, dtype=numpy.int64)
+    line = numpy.repeat(numpy.arange(len(counts), dtype=numpy.int64), counts_array)
+    starts = numpy.repeat(numpy.cumsum(counts_array) - counts_array, counts_array)
+    probenumber = numpy.arange(len(fields), dtype=numpy.int64) - starts + 1
+
+    text = numpy.char.strip(numpy.asarray(fields, dtype=str))
+    present = text != ""
+    value = numpy.full(len(fields), numpy.nan)
+    not_numbers = set()
+    try:
+        value[present] = text[present].astype(numpy.float64)
+    except ValueError:
+        # Find the offending fields one by one, only when the block has any
+        for index in numpy.flatnonzero(present):
+            try:
+                value[index] = float(text[index])
+            except ValueError:
+                not_numbers.add(int(line[index]))
+    # nan and inf parse as floats but are not readings
+    not_finite = set(numpy.unique(line[present & ~numpy.isfinite(value)]).tolist()) - not_numbers
+    errors.extend((number, "value is not a number") for number in not_numbers)
+    errors.extend((number, "value is not finite") for number in not_finite)
+
+    line_ok = numpy.asarray([bool(serial) for serial in line_serials], dtype=bool)
+    line_ok[sorted(not_numbers | not_finite)] = False
+    # Intern serialnumbers of accepted lines only
+    serial_index: dict[str, int] = {}
+    units = numpy.full(len(line_serials), -1, dtype=numpy.int64)
+    for number in numpy.flatnonzero(line_ok).tolist():
+        units[number] = serial_index.setdefault(line_serials[number], len(serial_index))
+
+    keep = present & line_ok[line]
+    return SensordataBlock(
+        serials=list(serial_index),
+        line=line[keep],
+        unit=units[line[keep]],
+        timestamp=numpy.asarray(stamps, dtype=numpy.int64)[line[keep]],
+        packagecounter=numpy.asarray(counters, dtype=numpy.int64)[line[keep]],
+        probenumber=probenumber[keep],
+        value=value[keep],
+        errors=sorted(errors),
+    )
+
+
+def latest_per_probe(block: SensordataBlock) -> "numpy.ndarray":
+    """Return indexes of the newest value per ``(unit, probenumber)``.
+
+    Values with equal timestamps keep the one that came last in the block.
+    """
+    order = numpy.lexsort((numpy.arange(len(block.value)), block.timestamp, block.probenumber, block.unit))
+    unit = block.unit[order]
+    probe = block.probenumber[order]
+    last = numpy.ones(len(order), dtype=bool)
+    last[:-1] = (unit[1:] != unit[:-1]) | (probe[1:] != probe[:-1])
+    return order[last]
+
+
+def lttb(x: Sequence[float], y: Sequence[float], threshold: int) -> list[int]:
+    """Return indexes of at most ``threshold`` points chosen by largest triangle three buckets.
+
+    ``x`` must be ascending. The first and last points are always kept; from
+    every bucket in between the point forming the largest triangle with the
+    previously chosen point and the average of the next bucket is picked, which
+    keeps peaks and dips that plain decimation would drop.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+    every = (n - 2) / (threshold - 2)
+    selected = [0]
+    a = 0
+    for i in range(threshold - 2):
+        start = int((i + 1) * every) + 1
+        end = min(int((i + 2) * every) + 1, n)
+        avg_x = sum(x[start:end]) / (end - start)
+        avg_y = sum(y[start:end]) / (end - start)
+        ax, ay = x[a], y[a]
+        best, best_area = start, -1.0
+        for j in range(int(i * every) + 1, start):
+            area = abs((ax - avg_x) * (y[j] - ay) - (ax - x[j]) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        selected.append(best)
+        a = best
+    selected.append(n - 1)
+    return selected
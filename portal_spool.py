@@ -0,0 +1,141 @@
+"""Segmented spool for incoming sensordata with group commit.
+
+Readings are appended as ``timestamp,serialnumber,sensordata,packagecounter``
+lines, the format the importer already reads, to an open segment file in a
+staging directory. Appends arriving within ``PORTAL_SPOOL_COMMIT_INTERVAL``
+seconds share one ``fsync``. A segment is sealed, by renaming it into the
+spool directory as ``*.aa``, once it holds ``PORTAL_SPOOL_SEGMENT_LINES`` lines
+or is ``PORTAL_SPOOL_SEGMENT_SECONDS`` old, so the importer, which reads every
+file in the spool directory, only ever sees complete files.
+
+``PORTAL_SPOOL_DIR``
+    Directory the importer reads (default ``/tmp``).
+``PORTAL_SPOOL_STAGING_DIR``
+    Directory for open segments (default ``.portal_spool`` inside
+    ``PORTAL_SPOOL_DIR``). It must be on the same filesystem so sealing is an
+    atomic rename.
+``PORTAL_SPOOL_COMMIT_INTERVAL``
+    Group commit window in seconds (default 0.005, 0 for one fsync per batch).
+``PORTAL_SPOOL_SEGMENT_LINES`` / ``PORTAL_SPOOL_SEGMENT_SECONDS``
+    Seal limits per segment (default 10000 lines and 2 seconds).
+"""
+
+import asyncio
+import os
+import time
+from typing import Iterable, Optional
+
+
+def format_line(timestamp: int, serialnumber: str, sensordata: str, packagecounter: int) -> str:
+    """Return one spool line; same layout as ``/v1/sensordata/add`` writes."""
+    return f"{timestamp},{serialnumber},{sensordata},{packagecounter}"
+
+
+class SensordataSpool:
+    """Append-only spool of sensordata lines in sealed segment files."""
+
+    def __init__(
+        self,
+        directory: Optional[str] = None,
+        *,
+        staging_directory: Optional[str] = None,
+        commit_interval: Optional[float] = None,
+        segment_lines: Optional[int] = None,
+        segment_seconds: Optional[float] = None,
+    ) -> None:
+        self.directory = directory or os.getenv("PORTAL_SPOOL_DIR", "/tmp")
+        self.staging_directory = staging_directory or os.getenv(
+            "PORTAL_SPOOL_STAGING_DIR", os.path.join(self.directory, ".portal_spool")
+        )
+        self.commit_interval = (
+            commit_interval
+            if commit_interval is not None
+            else float(os.getenv("PORTAL_SPOOL_COMMIT_INTERVAL", "0.005"))
+        )
+        self.segment_lines = segment_lines or int(os.getenv("PORTAL_SPOOL_SEGMENT_LINES", "10000"))
+        self.segment_seconds = segment_seconds or float(os.getenv("PORTAL_SPOOL_SEGMENT_SECONDS", "2"))
+        self._file = None
+        self._name: Optional[str] = None
+        self._lines = 0
+        self._opened = 0.0
+        self._seq = 0
+        self._commit_task: Optional[asyncio.Task] = None
+        self._seal_task: Optional[asyncio.Task] = None
+        self._fsync_lock = asyncio.Lock()
+        self.commits = 0
+        self.sealed = 0
+
+    def _open_segment(self) -> None:
+        self._seq += 1
+        self._name = f"sensordata_{os.getpid()}_{int(time.time())}_{self._seq:06d}"
+        os.makedirs(self.staging_directory, exist_ok=True)
+        self._file = open(os.path.join(self.staging_directory, self._name + ".part"), "a", encoding="utf-8")
+        self._lines = 0
+        self._opened = time.monotonic()
+        if self._seal_task is None or self._seal_task.done():
+            self._seal_task = asyncio.ensure_future(self._seal_when_old())
+
+    async def append(self, lines: Iterable[str]) -> int:
+        """Append ``lines`` and return once they are fsynced to disk."""
+        lines = list(lines)
+        if not lines:
+            return 0
+        if self._file is None:
+            self._open_segment()
+        self._file.write("".join(line + "\n" for line in lines))
+        self._lines += len(lines)
+        if self._commit_task is None:
+            self._commit_task = asyncio.ensure_future(self._group_commit())
+        await asyncio.shield(self._commit_task)
+        return len(lines)
+
+    async def _group_commit(self) -> None:
+        if self.commit_interval > 0:
+            await asyncio.sleep(self.commit_interval)
+        # Appends from now on join the next group
+        self._commit_task = None
+        await self._sync()
+
+    async def _sync(self, seal: bool = False) -> None:
+        """Fsync everything written so far; seal the segment if it is full or old."""
+        file, name = self._file, self._name
+        if file is None:
+            return
+        seal = seal or self._lines >= self.segment_lines or (
+            time.monotonic() - self._opened >= self.segment_seconds
+        )
+        if seal:
+            self._file = self._name = None
+        async with self._fsync_lock:
+            file.flush()
+            await asyncio.to_thread(os.fsync, file.fileno())
+            self.commits += 1
+            if seal:
+                file.close()
+                os.rename(
+                    os.path.join(self.staging_directory, name + ".part"),
+                    os.path.join(self.directory, name + ".aa"),
+                )
+                self.sealed += 1
+
+    async def _seal_when_old(self) -> None:
+        # Seal quiet segments so the importer does not wait for more data
+        while self._file is not None:
+            remaining = self._opened + self.segment_seconds - time.monotonic()
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+            elif self._commit_task is not None:
+                await asyncio.shield(self._commit_task)
+            else:
+                await self._sync(seal=True)
+
+    async def close(self) -> None:
+        """Commit and seal the open segment."""
+        if self._commit_task is not None:
+            await self._commit_task
+        await self._sync(seal=True)
+        if self._seal_task is not None:
+            self._seal_task.cancel()
+
+    def stats(self) -> dict:
+        return {"commits": self.commits, "sealed_segments": self.sealed, "open_lines": self._lines if self._file else 0}
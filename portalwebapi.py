@@ -1,5 +1,14 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel
+import asyncio
+import base64
+import binascii
+import contextlib
+import datetime
+import itertools
 import os
+import re
 import tempfile
 import time
 import sqlite3
@@ -7,7 +16,7 @@ import logging
 import json
 import smtplib
 from email.message import EmailMessage
-from typing import Optional
+from typing import AsyncIterator, Optional
 import httpx
 
 logging.basicConfig(
@@ -17,24 +26,256 @@ logging.basicConfig(
 )
 
 try:
-    from .portal_db import PortalDB  # when imported as package
+    from .portal_admission import AdmissionLimiter, AdmissionMiddleware
+    from .portal_cache import InvalidationBus, QueryCache, SensorAccessIndex, SensorunitIndex, UserSensorunitLists
+    from .portal_db import PoolTimeoutError, PortalDB, PortalDBRegistry, StatementTimeoutError  # when imported as package
+    from .portal_json import (
+        STREAM_MEDIA_TYPES, columnar, encode_json, epoch_seconds, json_default, stream_json_object, stream_json_rows,
+    )
+    from .portal_sensordata import lttb
+    from .portal_ingest import IngestPipeline, IngestQueueFull, Reading
+    from .portal_spool import SensordataSpool, format_line
+    from .portal_metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, render_admission_metrics, render_pool_metrics
 except ImportError:  # pragma: no cover - direct execution
-    from portal_db import PortalDB
+    from portal_admission import AdmissionLimiter, AdmissionMiddleware
+    from portal_cache import InvalidationBus, QueryCache, SensorAccessIndex, SensorunitIndex, UserSensorunitLists
+    from portal_db import PoolTimeoutError, PortalDB, PortalDBRegistry, StatementTimeoutError
+    from portal_json import (
+        STREAM_MEDIA_TYPES, columnar, encode_json, epoch_seconds, json_default, stream_json_object, stream_json_rows,
+    )
+    from portal_sensordata import lttb
+    from portal_ingest import IngestPipeline, IngestQueueFull, Reading
+    from portal_spool import SensordataSpool, format_line
+    from portal_metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, render_admission_metrics, render_pool_metrics
 
 app = FastAPI()
 
+# Shed load with 503 instead of queueing when the database cannot keep up
+admission = AdmissionLimiter()
+app.add_middleware(AdmissionMiddleware, limiter=admission)
+
 db = PortalDB()
+# Customer specific sensordata databases, kept open between requests
+sensordbs = PortalDBRegistry()
+# Segment files for batched sensordata, read by the same importer as
+# the single /v1/sensordata/add files
+sensordata_spool = SensordataSpool()
+# Lookup tables that rarely change; write endpoints invalidate their table
+reference_cache = QueryCache()
+# Write endpoints publish the tables they change to the caches of all workers
+invalidation = InvalidationBus(db)
+# Serialnumber -> sensorunit_id, dbname, customer and product of each unit
+sensorunit_index = SensorunitIndex(db)
+
+# One row per sensoraccess grant, as listed by /v1/sensorunits/list
+SENSORUNITS_LIST_QUERY = (
+    "SELECT sensoraccess.serialnumber, sensoraccess.changeallowed, sensoraccess.user_id, "
+    "products.product_name, products.product_description, products.productnumber, "
+    "products.product_type, products.product_image_url, sensorunits.sensorunit_installdate, "
+    "sensorunits.sensorunit_lastconnect, sensorunits.sensorunit_location, sensorunits.sensorunit_xpos, "
+    "sensorunits.sensorunit_zpos, sensorunits.sensorunit_status, sensorunits.block, "
+    "customertype.description, customertype.customertype, products.product_id, customertype.customertype_id, "
+    "sensorunits.sensorunit_ypos, sensorunits.sensorunit_note, customer.customernumber, customer.customer_name, "
+    "customer.customer_site_title, customer.customer_id, customer.customer_maincontact, documents.document_url, "
+    "documents.document_name, helpdesks.helpdesk_phone, helpdesks.helpdesk_email "
+    "FROM sensoraccess "
+    "INNER JOIN sensorunits ON (sensoraccess.serialnumber = sensorunits.serialnumber) "
+    "INNER JOIN products ON (sensorunits.product_id_ref = products.product_id) "
+    "INNER JOIN customer ON (sensorunits.customer_id_ref = customer.customer_id) "
+    "INNER JOIN customertype ON (customer.customertype_id_ref = customertype.customertype_id) "
+    "INNER JOIN documents ON (products.document_id_ref=documents.document_id) "
+    "INNER JOIN helpdesks ON (sensorunits.helpdesk_id_ref = helpdesks.helpdesk_id)"
+)
+
+# Per-user /v1/sensorunits/list rows, refreshed per grant on invalidation
+user_sensorunits = UserSensorunitLists(db, SENSORUNITS_LIST_QUERY)
+# user_id <-> serialnumber grants from sensoraccess, for access checks
+sensor_access = SensorAccessIndex(db)
+invalidation.subscribe(reference_cache.on_invalidate)
+invalidation.subscribe(sensor_access.on_invalidate)
+invalidation.subscribe(sensorunit_index.on_invalidate)
+invalidation.subscribe(user_sensorunits.on_invalidate)
+
+# With PORTAL_INGEST_PIPELINE=1 /v1/sensordata/add writes straight to the
+# customer databases instead of leaving a file for the importer
+ingest = (
+    IngestPipeline(db, sensordbs, sensorunit_index.get, fallback=sensordata_spool)
+    if os.getenv("PORTAL_INGEST_PIPELINE", "0") == "1"
+    else None
+)
+
+# Customer databases queried at the same time by one /v1/sensorunits/data/batch
+# request
+SENSORDATA_BATCH_CONCURRENCY = int(os.getenv("PORTAL_BATCH_CONCURRENCY", "4"))
+
+# List endpoints that encode asyncpg records straight to JSON bytes instead of
+# converting them to dicts and running FastAPI's jsonable_encoder. Override
+# with PORTAL_FAST_JSON (comma separated paths, empty to disable).
+FAST_JSON_ENDPOINTS = frozenset(
+    path.strip()
+    for path in os.getenv(
+        "PORTAL_FAST_JSON", "/v1/sensorunits/data,/v1/sensorunits/data/latest"
+    ).split(",")
+    if path.strip()
+)
+
+
+def fast_json(path: str) -> bool:
+    return path in FAST_JSON_ENDPOINTS
+
+
+def check_format(format: Optional[str]) -> None:
+    if format not in (None, "rows", "columnar"):
+        raise HTTPException(status_code=400, detail="Parameter format must be rows or columnar")
+
+
+def format_rows(rows, format: Optional[str], columns: list[str], epoch: bool):
+    """Return ``rows`` unchanged, or as one array per column for ``format=columnar``."""
+    if format != "columnar":
+        return rows
+    return columnar(rows, columns, ("timestamp",) if epoch else ())
+
+
+BUCKET_SECONDS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+# Aggregates for /v1/sensorunits/data?bucket=..., by name of the result column
+SENSORDATA_AGGREGATES = {
+    "min": "min(value)",
+    "max": "max(value)",
+    "avg": "avg(value)",
+    "count": "count(value)",
+    "first": "(array_agg(value ORDER BY timestamp))[1]",
+    "last": "(array_agg(value ORDER BY timestamp DESC))[1]",
+}
+
+
+def parse_bucket(bucket: str) -> int:
+    """Return the length in seconds of a bucket such as ``15m`` or ``1h``."""
+    number, unit = bucket[:-1], bucket[-1:]
+    if not (number.isascii() and number.isdecimal()) or int(number) == 0 or unit not in BUCKET_SECONDS:
+        raise HTTPException(status_code=400, detail="Parameter bucket must be a number followed by s, m, h or d")
+    return int(number) * BUCKET_SECONDS[unit]
+
+
+def parse_time(value: str, name: str) -> datetime.datetime:
+    """Parse an ISO 8601 time or Unix seconds into a naive timestamp for ``sensordata``.
+
+    Times with an offset and Unix seconds are converted to UTC; naive times
+    are compared as they are stored.
+    """
+    try:
+        if value.isascii() and value.isdecimal():
+            parsed = datetime.datetime.fromtimestamp(int(value), datetime.timezone.utc)
+        else:
+            parsed = datetime.datetime.fromisoformat(value)
+    except (ValueError, OverflowError):
+        raise HTTPException(status_code=400, detail=f"Parameter {name} must be an ISO 8601 time or Unix seconds")
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def sensordata_range(timestart: Optional[str], timestop: Optional[str], days: Optional[float]) -> tuple[str, list]:
+    """Return ``AND`` predicates on ``sensordata.timestamp`` and their parameters.
+
+    The predicates compare the column itself so the ``(serialnumber,
+    timestamp)`` index can be used for the range.
+    """
+    start = parse_time(timestart, "timestart") if timestart else None
+    stop = parse_time(timestop, "timestop") if timestop else None
+    if start and stop and start > stop:
+        raise HTTPException(status_code=400, detail="Parameter timestart must be before timestop")
+    if days is not None and days <= 0:
+        raise HTTPException(status_code=400, detail="Parameter days must be positive")
+    clause = ""
+    params: list = []
+    if days is not None:
+        # Naive UTC like the stored timestamps, whatever the session time zone
+        clause += " AND timestamp >= (now() AT TIME ZONE 'UTC') - ? * interval '1 day'"
+        params.append(days)
+    if start is not None:
+        clause += " AND timestamp >= ?"
+        params.append(start)
+    if stop is not None:
+        clause += " AND timestamp <= ?"
+        params.append(stop)
+    return clause, params
+
+
+# Numeric offsets like the Perl default "+01", or zone names like Europe/Oslo
+TIMEZONE_PATTERN = re.compile(r"[+-]\d{1,2}(:?\d{2})?|[A-Za-z_]+(/[A-Za-z0-9_+-]+)*")
+
+# Probe numbers of one unittype on one product, for /v1/sensorunits/data?unittype=
+UNITTYPE_PROBES_QUERY = (
+    "SELECT sensorprobes_number FROM sensorprobes WHERE product_id_ref=? AND unittype_id_ref=?"
+)
+
+
+def parse_aggregates(agg: Optional[str]) -> list[str]:
+    names = [name.strip() for name in (agg or "avg").split(",") if name.strip()]
+    if not names or any(name not in SENSORDATA_AGGREGATES for name in names):
+        raise HTTPException(
+            status_code=400, detail="Parameter agg must be a list of " + ", ".join(SENSORDATA_AGGREGATES)
+        )
+    return list(dict.fromkeys(names))
+
+
+def downsample(rows, points: int) -> list:
+    """Reduce the rows of each probe to ``points`` rows with :func:`portal_sensordata.lttb`.
+
+    ``rows`` must be ordered by probenumber and timestamp. Rows without a
+    value are left out.
+    """
+    result = []
+    for _, group in itertools.groupby(rows, key=lambda r: r["probenumber"]):
+        series = [r for r in group if r["value"] is not None]
+        x = [epoch_seconds(r["timestamp"]) for r in series]
+        y = [float(r["value"]) for r in series]
+        result.extend(series[i] for i in lttb(x, y, points))
+    return result
+
+
+def result_response(path: str, rows, **extra):
+    """Return ``{"result": rows, **extra}``, pre-encoded for fast JSON endpoints."""
+    body = {"result": rows, **extra}
+    if fast_json(path):
+        return Response(content=encode_json(body), media_type="application/json")
+    return body
+
+
+@app.exception_handler(PoolTimeoutError)
+async def pool_timeout_handler(request, exc: PoolTimeoutError):
+    """Answer ``503`` when no database connection is free in time."""
+    logging.warning("Database pool %s exhausted for %s", exc, request.url.path)
+    return admission.overloaded_response("Database busy, try again later")
+
+
+@app.exception_handler(StatementTimeoutError)
+async def statement_timeout_handler(request, exc: StatementTimeoutError):
+    """Answer ``504`` when a statement ran past the endpoint's deadline."""
+    logging.warning("Statement timeout for %s: %s", request.url.path, exc)
+    return JSONResponse({"detail": "Query timed out"}, status_code=504)
 
 
 @app.on_event("startup")
 async def startup() -> None:
-    """Open the shared database connection pool."""
+    """Open the shared database connection pool and listen for cache invalidations."""
     await db.connect()
+    await invalidation.start()
+    if ingest is not None:
+        ingest.start()
+    if os.getenv("PORTAL_SENSORUNIT_PRELOAD", "0") == "1":
+        count = await sensorunit_index.load()
+        logging.info("Loaded %d sensorunits into the serialnumber index", count)
 
 
 @app.on_event("shutdown")
 async def shutdown() -> None:
-    """Close the shared database connection pool."""
+    """Flush queued sensordata and close the shared database connection pools."""
+    if ingest is not None:
+        await ingest.close()
+    await sensordata_spool.close()
+    await sensordbs.close()
     await db.close()
 
 @app.delete("/v1/customers/delete")
@@ -64,6 +305,7 @@ async def v1_customers_delete(customernumber: Optional[str] = None, customer_id:
     rowcount = await db.execute(f"DELETE FROM customer WHERE {where}", params)
     if rowcount == 0:
         raise HTTPException(status_code=404, detail=f"No record for {desc}")
+    await invalidation.publish("customer")
     return {"message": "OK"}
 
 
@@ -115,15 +357,12 @@ async def v1_customers_variable_update(
             status_code=400,
             detail="Missing parameter: needs customernumber, variable and value",
         )
-    rowcount = await db.execute(
-        "UPDATE customer_variables SET value=? WHERE customernumber=? AND variable=?",
-        (value, customernumber, variable),
+    await db.upsert(
+        "customer_variables",
+        ("customernumber", "variable"),
+        {"customernumber": customernumber, "variable": variable, "value": value},
     )
-    if rowcount == 0:
-        await db.execute(
-            "INSERT INTO customer_variables (customernumber, variable, value) VALUES (?, ?, ?)",
-            (customernumber, variable, value),
-        )
+    await invalidation.publish("customer_variables")
     return {"result": "OK"}
 
 
@@ -160,6 +399,7 @@ async def v1_customers_variable_delete(
             status_code=404,
             detail=f"No record for customernumber:{customernumber}, variable:{variable}",
         )
+    await invalidation.publish("customer_variables")
     return {"message": "OK"}
 
 
@@ -238,57 +478,43 @@ async def v1_helpdesks_add(
     if not helpdesknumber:
         raise HTTPException(status_code=400, detail="Missing parameter: needs helpdesknumber")
 
-    existing = await db.fetchone(
-        "SELECT helpdesknumber FROM helpdesks WHERE helpdesknumber=?",
-        (helpdesknumber,),
-    )
-    if existing:
+    created = await db.insert_unique(
+        "helpdesks",
+        ("helpdesknumber",),
+        {
+            "helpdesknumber": helpdesknumber,
+            "helpdesk_name": helpdesk_name,
+            "helpdesk_vatnumber": helpdesk_vatnumber,
+            "helpdesk_phone": helpdesk_phone,
+            "helpdesk_fax": helpdesk_fax,
+            "helpdesk_email": helpdesk_email,
+            "helpdesk_web": helpdesk_web,
+            "helpdesk_visitaddr1": helpdesk_visitaddr1,
+            "helpdesk_visitaddr2": helpdesk_visitaddr2,
+            "helpdesk_visitpostcode": helpdesk_visitpostcode,
+            "helpdesk_visitcity": helpdesk_visitcity,
+            "helpdesk_visitcountry": helpdesk_visitcountry,
+            "helpdesk_invoiceaddr1": helpdesk_invoiceaddr1,
+            "helpdesk_invoiceaddr2": helpdesk_invoiceaddr2,
+            "helpdesk_invoicepostcode": helpdesk_invoicepostcode,
+            "helpdesk_invoicecity": helpdesk_invoicecity,
+            "helpdesk_invoicecountry": helpdesk_invoicecountry,
+            "helpdesk_deliveraddr1": helpdesk_deliveraddr1,
+            "helpdesk_deliveraddr2": helpdesk_deliveraddr2,
+            "helpdesk_deliverpostcode": helpdesk_deliverpostcode,
+            "helpdesk_delivercity": helpdesk_delivercity,
+            "helpdesk_delivercountry": helpdesk_delivercountry,
+            "helpdesk_maincontact": helpdesk_maincontact,
+            "helpdesk_deliveraddr_same_as_invoice": helpdesk_deliveraddr_same_as_invoice,
+            "helpdesk_invoiceaddr_same_as_visit": helpdesk_invoiceaddr_same_as_visit,
+        },
+    )
+    if not created:
         raise HTTPException(
             status_code=302,
             detail=f"Record exists for helpdesknumber:{helpdesknumber}",
         )
-
-    await db.execute(
-        """
-        INSERT INTO helpdesks (
-            helpdesknumber,helpdesk_name,helpdesk_vatnumber,helpdesk_phone,
-            helpdesk_fax,helpdesk_email,helpdesk_web,helpdesk_visitaddr1,
-            helpdesk_visitaddr2,helpdesk_visitpostcode,helpdesk_visitcity,
-            helpdesk_visitcountry,helpdesk_invoiceaddr1,helpdesk_invoiceaddr2,
-            helpdesk_invoicepostcode,helpdesk_invoicecity,helpdesk_invoicecountry,
-            helpdesk_deliveraddr1,helpdesk_deliveraddr2,helpdesk_deliverpostcode,
-            helpdesk_delivercity,helpdesk_delivercountry,helpdesk_maincontact,
-            helpdesk_deliveraddr_same_as_invoice,helpdesk_invoiceaddr_same_as_visit
-        ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-        """,
-        (
-            helpdesknumber,
-            helpdesk_name,
-            helpdesk_vatnumber,
-            helpdesk_phone,
-            helpdesk_fax,
-            helpdesk_email,
-            helpdesk_web,
-            helpdesk_visitaddr1,
-            helpdesk_visitaddr2,
-            helpdesk_visitpostcode,
-            helpdesk_visitcity,
-            helpdesk_visitcountry,
-            helpdesk_invoiceaddr1,
-            helpdesk_invoiceaddr2,
-            helpdesk_invoicepostcode,
-            helpdesk_invoicecity,
-            helpdesk_invoicecountry,
-            helpdesk_deliveraddr1,
-            helpdesk_deliveraddr2,
-            helpdesk_deliverpostcode,
-            helpdesk_delivercity,
-            helpdesk_delivercountry,
-            helpdesk_maincontact,
-            helpdesk_deliveraddr_same_as_invoice,
-            helpdesk_invoiceaddr_same_as_visit,
-        ),
-    )
+    await invalidation.publish("helpdesks")
     return {"result": "OK"}
 
 
@@ -389,6 +615,7 @@ async def v1_helpdesks_update(
             status_code=404,
             detail=f"Missing record for helpdesknumber:{helpdesknumber}",
         )
+    await invalidation.publish("helpdesks")
     return {"result": "OK"}
 
 
@@ -416,6 +643,7 @@ async def v1_helpdesks_delete(
     rowcount = await db.execute(f"DELETE FROM helpdesks WHERE {where}", (param,))
     if rowcount == 0:
         raise HTTPException(status_code=404, detail=f"No record for {desc}")
+    await invalidation.publish("helpdesks")
     return {"message": "OK"}
 
 
@@ -427,8 +655,15 @@ async def v1_messages_list(
     customer_id_ref: Optional[int] = None,
     serialnumber: Optional[str] = None,
     sortfield: Optional[str] = None,
+    after: Optional[str] = None,
 ):
-    """List messages joined with customer data."""
+    """List messages joined with customer data.
+
+    Without ``sortfield`` messages are ordered newest first and a ``next``
+    cursor is returned for use as ``after`` on the following call.
+    """
+    if after and sortfield:
+        raise HTTPException(status_code=400, detail="Parameter after can not be combined with sortfield")
     query = (
         "SELECT archived,message,timestamp,checkedbyuser,serialnumber,message_id,"
         "customer.customer_id,customer.customernumber FROM messages "
@@ -455,13 +690,20 @@ async def v1_messages_list(
         where_clauses.append("serialnumber=?")
         params.append(serialnumber)
 
+    keyset = ["timestamp", "message_id"]
+    keyset_types = (datetime.datetime, int)
+    if after:
+        clause, values = keyset_where(keyset, after, descending=True, types=keyset_types)
+        where_clauses.append(clause)
+        params.extend(values)
+
     if where_clauses:
         query += " WHERE " + " AND ".join(where_clauses)
 
     if sortfield:
         query += f" ORDER BY {sortfield}"
     else:
-        query += " ORDER BY timestamp desc"
+        query += keyset_order(keyset, descending=True)
     if limit is not None:
         query += " LIMIT ?"
         params.append(limit)
@@ -469,8 +711,11 @@ async def v1_messages_list(
         query += " OFFSET ?"
         params.append(offset)
 
-    rows = await db.fetchall(query, tuple(params))
-    return {"result": rows}
+    path = "/v1/messages/list"
+    rows = await db.fetchall(query, tuple(params), records=fast_json(path))
+    if sortfield:
+        return result_response(path, rows)
+    return result_response(path, rows, next=keyset_next(rows, keyset, limit))
 @app.post("/v1/messages/add")
 async def v1_messages_add(
     message: Optional[str] = None,
@@ -554,7 +799,7 @@ async def v1_customertypes_list(
     if offset is not None:
         query += " OFFSET ?"
         params.append(offset)
-    rows = await db.fetchall(query, tuple(params))
+    rows = await reference_cache.fetchall(db, "customertype", query, tuple(params))
     return {"result": rows}
 
 
@@ -567,6 +812,7 @@ async def v1_customertypes_add(customertype: Optional[str] = None, description:
         "INSERT INTO customertype (customertype, description) VALUES (?, ?)",
         (customertype, description),
     )
+    await invalidation.publish("customertype")
     return {"result": "OK"}
 
 
@@ -603,6 +849,7 @@ async def v1_customertypes_update(
             status_code=302,
             detail=f"Record does not exists for customertype_id:{customertype_id}",
         )
+    await invalidation.publish("customertype")
     return {"result": "OK"}
 
 
@@ -620,6 +867,7 @@ async def v1_customertypes_delete(customertype_id: Optional[int] = None):
             status_code=404,
             detail=f"No record for customertype_id:{customertype_id}",
         )
+    await invalidation.publish("customertype")
     return {"message": "OK"}
 
 
@@ -663,21 +911,22 @@ async def v1_gui_viewgroup_add(
             status_code=400,
             detail="Missing parameter: needs customernumber and viewgroup_name. Option viewgroup_description",
         )
-    existing = await db.fetchone(
-        "SELECT viewgroup_name FROM gui_viewgroup WHERE customernumber=? AND viewgroup_name=?",
-        (customernumber, viewgroup_name),
+    created = await db.insert_unique(
+        "gui_viewgroup",
+        ("customernumber", "viewgroup_name"),
+        {
+            "customernumber": customernumber,
+            "viewgroup_name": viewgroup_name,
+            "viewgroup_description": viewgroup_description or "",
+        },
     )
-    if existing:
+    if not created:
         raise HTTPException(
             status_code=302,
             detail=(
                 f"Record exists for customernumber:{customernumber} and viewgroup_name:{viewgroup_name}"
             ),
         )
-    await db.execute(
-        "INSERT INTO gui_viewgroup (customernumber, viewgroup_name, viewgroup_description) VALUES (?, ?, ?)",
-        (customernumber, viewgroup_name, viewgroup_description or ""),
-    )
     return {"result": "OK"}
 
 
@@ -894,7 +1143,7 @@ async def v1_variabletypes_list(
     if offset is not None:
         query += " OFFSET ?"
         params.append(offset)
-    rows = await db.fetchall(query, tuple(params))
+    rows = await reference_cache.fetchall(db, "variable_types", query, tuple(params))
     return {"result": rows}
 
 
@@ -920,7 +1169,7 @@ async def v1_countries_list(
     if offset is not None:
         query += " OFFSET ?"
         params.append(offset)
-    rows = await db.fetchall(query, tuple(params))
+    rows = await reference_cache.fetchall(db, "countries", query, tuple(params))
     return {"result": rows}
 
 
@@ -939,6 +1188,63 @@ async def v1_sensordata_rename(dbname: Optional[str] = None):
     return {"message": "OK"}
 
 
+async def move_sensorunits(serialnumbers: list[str], customernumber: str) -> tuple[int, list[str]]:
+    """Move sensorunits to ``customernumber`` using set-based statements.
+
+    Access rights and message receivers are recreated for every user of the
+    new customer with one ``INSERT ... SELECT`` each, so the number of round
+    trips does not depend on the number of users or units. Returns the number
+    of units that changed customer and the removed and added grants as
+    ``"user_id:serialnumber"`` keys for the ``sensoraccess`` invalidation.
+    """
+    async with db.transaction() as tx:
+        row = await tx.fetchone(
+            "SELECT customer_id FROM customer WHERE customernumber=?",
+            (customernumber,),
+        )
+        if row is None:
+            raise HTTPException(status_code=400, detail=f"Did not find customernumber: {customernumber}")
+        customer_id = row["customer_id"]
+        units = await tx.fetchall(
+            "SELECT sensorunit_id, serialnumber, customernumber FROM sensorunits WHERE serialnumber = ANY(?)",
+            (serialnumbers,),
+        )
+        found = {u["serialnumber"] for u in units}
+        missing = [s for s in serialnumbers if s not in found]
+        if missing:
+            raise HTTPException(status_code=400, detail=f"Did not find serialnumber: {','.join(missing)}")
+        moving = [u for u in units if u["customernumber"] != customernumber]
+        if not moving:
+            return 0, []
+        serials = [u["serialnumber"] for u in moving]
+        unit_ids = [u["sensorunit_id"] for u in moving]
+        removed = await tx.fetchall(
+            "DELETE FROM sensoraccess WHERE serialnumber = ANY(?) RETURNING user_id, serialnumber", (serials,)
+        )
+        await tx.execute("DELETE FROM message_receivers WHERE sensorunits_id_ref = ANY(?)", (unit_ids,))
+        await tx.execute("DELETE FROM gui_viewgroup_order WHERE serialnumber = ANY(?)", (serials,))
+        added = await tx.fetchall(
+            "INSERT INTO sensoraccess (user_id, serialnumber, changeallowed) "
+            "SELECT users.user_id, sensorunits.serialnumber, 'true' FROM users CROSS JOIN sensorunits "
+            "WHERE users.customer_id_ref=? AND sensorunits.serialnumber = ANY(?) "
+            "RETURNING user_id, serialnumber",
+            (customer_id, serials),
+        )
+        await tx.execute(
+            "INSERT INTO message_receivers (users_id_ref, sensorunits_id_ref) "
+            "SELECT users.user_id, sensorunits.sensorunit_id FROM users CROSS JOIN sensorunits "
+            "WHERE users.customer_id_ref=? AND sensorunits.serialnumber = ANY(?)",
+            (customer_id, serials),
+        )
+        database_name = "sensordata_" + customernumber[3:7]
+        await tx.execute(
+            "UPDATE sensorunits SET customernumber=?, customer_id_ref=?, dbname=? WHERE serialnumber = ANY(?)",
+            (customernumber, customer_id, database_name, serials),
+        )
+    grants = dict.fromkeys(f"{r['user_id']}:{r['serialnumber']}" for r in [*removed, *added])
+    return len(moving), list(grants)
+
+
 @app.patch("/v1/sensorunit/move2customer")
 async def v1_sensorunit_move2customer(
     serialnumber: Optional[str] = None,
@@ -950,46 +1256,39 @@ async def v1_sensorunit_move2customer(
             status_code=400,
             detail="Missing parameter: needs serialnumber and customernumber",
         )
-    row = await db.fetchone(
-        "SELECT sensorunit_id, customernumber FROM sensorunits WHERE serialnumber=?",
-        (serialnumber,),
-    )
-    if row is None:
-        raise HTTPException(status_code=400, detail=f"Did not find serialnumber: {serialnumber}")
-    if row["customernumber"] == customernumber:
+    moved, grants = await move_sensorunits([serialnumber], customernumber)
+    if moved == 0:
         return {"message": "No change needed"}
-    sensorunit_id = row["sensorunit_id"]
-    await db.execute("DELETE FROM sensoraccess WHERE serialnumber=?", (serialnumber,))
-    await db.execute("DELETE FROM message_receivers WHERE sensorunits_id_ref=?", (sensorunit_id,))
-    await db.execute("DELETE FROM gui_viewgroup_order WHERE serialnumber=?", (serialnumber,))
-    row = await db.fetchone(
-        "SELECT customer_id FROM customer WHERE customernumber=?",
-        (customernumber,),
-    )
-    if row is None:
-        raise HTTPException(status_code=400, detail=f"Did not find customernumber: {customernumber}")
-    customer_id = row["customer_id"]
-    users = await db.fetchall(
-        "SELECT user_id FROM users WHERE customer_id_ref=?",
-        (customer_id,),
-    )
-    for u in users:
-        await db.execute(
-            "INSERT INTO sensoraccess (user_id, serialnumber, changeallowed) VALUES (?, ?, 'true')",
-            (u["user_id"], serialnumber),
-        )
-        await db.execute(
-            "INSERT INTO message_receivers (users_id_ref, sensorunits_id_ref) VALUES (?, ?)",
-            (u["user_id"], sensorunit_id),
-        )
-    database_name = "sensordata_" + customernumber[3:7]
-    await db.execute(
-        "UPDATE sensorunits SET customernumber=?, customer_id_ref=?, dbname=? WHERE serialnumber=?",
-        (customernumber, customer_id, database_name, serialnumber),
-    )
+    await invalidation.publish("sensorunits", keys=[serialnumber])
+    if grants:
+        await invalidation.publish("sensoraccess", keys=grants)
     return {"message": "OK"}
 
 
+@app.patch("/v1/sensorunit/move2customer/bulk")
+async def v1_sensorunit_move2customer_bulk(
+    serialnumbers: Optional[str] = None,
+    customernumber: Optional[str] = None,
+):
+    """Move several sensorunits to another customer in one call.
+
+    ``serialnumbers`` is a comma separated list. The move is all or nothing:
+    if any serialnumber is unknown nothing is changed.
+    """
+    serials = [s.strip() for s in (serialnumbers or "").split(",") if s.strip()]
+    if not serials or not customernumber:
+        raise HTTPException(
+            status_code=400,
+            detail="Missing parameter: needs serialnumbers and customernumber",
+        )
+    serials = list(dict.fromkeys(serials))
+    moved, grants = await move_sensorunits(serials, customernumber)
+    await invalidation.publish("sensorunits", keys=serials)
+    if grants:
+        await invalidation.publish("sensoraccess", keys=grants)
+    return {"message": "OK", "moved": moved}
+
+
 @app.post("/v1/sensordata/add")
 async def v1_sensordata_add(
     serialnumber: Optional[str] = None,
@@ -998,10 +1297,24 @@ async def v1_sensordata_add(
     timestamp: Optional[int] = None,
     packagecounter: Optional[int] = 0,
 ):
-    """Add sensordata entry (writes to a temp file)."""
+    """Add sensordata entry.
+
+    Writes a file for the importer, or queues the reading for the ingestion
+    pipeline when it is enabled (``503`` while its queue is full).
+    """
     if not serialnumber or not sensordata:
         raise HTTPException(status_code=400, detail="Missing parameter: needs serialnumber and sensordata")
     ts = timestamp or int(time.time())
+    if ingest is not None:
+        try:
+            ingest.submit(Reading(ts, serialnumber, sensordata, packagecounter or 0))
+        except IngestQueueFull:
+            raise HTTPException(
+                status_code=503,
+                detail="Sensordata queue is full, try again later",
+                headers={"Retry-After": str(admission.retry_after)},
+            )
+        return {"result": "OK"}
     combined = f"{ts},{serialnumber},{sensordata},{packagecounter}"
     fd, path = tempfile.mkstemp(prefix=serialnumber, dir="/tmp")
     with os.fdopen(fd, "w") as f:
@@ -1010,6 +1323,38 @@ async def v1_sensordata_add(
 
 
 
+class SensordataRecord(BaseModel):
+    serialnumber: str
+    sensordata: str
+    timestamp: Optional[int] = None
+    packagecounter: Optional[int] = 0
+
+
+@app.post("/v1/sensordata/add/batch")
+async def v1_sensordata_add_batch(records: list[SensordataRecord]):
+    """Add many sensordata entries in one call.
+
+    The body is a JSON list of ``{"serialnumber", "sensordata", "timestamp",
+    "packagecounter"}`` objects. They are appended to the sensordata spool in
+    the ``timestamp,serialnumber,sensordata,packagecounter`` line format and
+    the call returns once they are fsynced.
+    """
+    if not records:
+        raise HTTPException(status_code=400, detail="Missing parameter: needs at least one record")
+    now = int(time.time())
+    lines = []
+    for record in records:
+        if not record.serialnumber or not record.sensordata:
+            raise HTTPException(status_code=400, detail="Missing parameter: needs serialnumber and sensordata")
+        if any("\n" in value or "\r" in value for value in (record.serialnumber, record.sensordata)):
+            raise HTTPException(status_code=400, detail=f"Line break in record for serialnumber:{record.serialnumber}")
+        lines.append(
+            format_line(record.timestamp or now, record.serialnumber, record.sensordata, record.packagecounter or 0)
+        )
+    count = await sensordata_spool.append(lines)
+    return {"result": "OK", "count": count}
+
+
 @app.post("/v1/event/add")
 async def v1_event_add(
     serialnumber: Optional[str] = None,
@@ -1082,13 +1427,10 @@ async def v1_sendmessage(
 
     else:
         if sensorunit_id is None and serialnumber:
-            row = await db.fetchone(
-                "SELECT sensorunit_id FROM sensorunits WHERE serialnumber=?",
-                (serialnumber,),
-            )
-            if row is None:
+            unit = await sensorunit_index.get(serialnumber)
+            if unit is None:
                 raise HTTPException(status_code=400, detail=f"Serialnumber {serialnumber} is missing in DB")
-            sensorunit_id = row["sensorunit_id"]
+            sensorunit_id = unit.sensorunit_id
         if sensorunit_id is not None:
             rows = await db.fetchall(
                 "SELECT users_id_ref,sms,email,push_notification FROM message_receivers where sensorunits_id_ref=?",
@@ -1101,6 +1443,7 @@ async def v1_sendmessage(
             ]
 
     count = 0
+    pushed = False
     for rec in recipients:
         uid = rec["id"]
         info = await db.fetchone(
@@ -1123,8 +1466,11 @@ async def v1_sendmessage(
                 sound = await get_user_variable(uid, "pushsound") or "notification.wav"
                 await send_push_notification(token, mailsubject, pushmessage.replace("\n", " "), sound, badge)
                 await update_user_variable(uid, "pushbadge", str(badge))
+                pushed = True
         count += 1
 
+    if pushed:
+        await invalidation.publish("user_variables")
     return {"result": "OK", "messages": count}
 
 
@@ -1149,13 +1495,10 @@ async def v1_pushmessage(
         recipients.append(user_id)
     else:
         if sensorunit_id is None and serialnumber:
-            row = await db.fetchone(
-                "SELECT sensorunit_id FROM sensorunits WHERE serialnumber=?",
-                (serialnumber,),
-            )
-            if row is None:
+            unit = await sensorunit_index.get(serialnumber)
+            if unit is None:
                 raise HTTPException(status_code=400, detail=f"Serialnumber {serialnumber} is missing")
-            sensorunit_id = row["sensorunit_id"]
+            sensorunit_id = unit.sensorunit_id
         if sensorunit_id is not None:
             rows = await db.fetchall(
                 "SELECT users_id_ref FROM message_receivers where sensorunits_id_ref=?",
@@ -1173,6 +1516,8 @@ async def v1_pushmessage(
         await send_push_notification(token, subject, message.replace("\n", " "), sound, badge)
         await update_user_variable(uid, "pushbadge", str(badge))
         count += 1
+    if count:
+        await invalidation.publish("user_variables")
     return {"result": "OK", "messages": count}
 
 
@@ -1186,15 +1531,11 @@ async def dbget_variable(serialnumber: str, variable: str):
 
 
 async def dbupdate_variable(serialnumber: str, variable: str, value: str) -> None:
-    count = await db.execute(
-        "UPDATE sensorunit_variables SET value=? WHERE serialnumber=? AND variable=?",
-        (value, serialnumber, variable),
+    await db.upsert(
+        "sensorunit_variables",
+        ("serialnumber", "variable"),
+        {"serialnumber": serialnumber, "variable": variable, "value": value},
     )
-    if count == 0:
-        await db.execute(
-            "INSERT INTO sensorunit_variables (serialnumber, variable, value) VALUES (?, ?, ?)",
-            (serialnumber, variable, value),
-        )
 
 
 async def get_user_variable(user_id: int, variable: str) -> Optional[str]:
@@ -1207,15 +1548,11 @@ async def get_user_variable(user_id: int, variable: str) -> Optional[str]:
 
 
 async def update_user_variable(user_id: int, variable: str, value: str) -> None:
-    count = await db.execute(
-        "UPDATE user_variables SET value=? WHERE user_id=? AND variable=?",
-        (value, user_id, variable),
+    await db.upsert(
+        "user_variables",
+        ("user_id", "variable"),
+        {"user_id": user_id, "variable": variable, "value": value},
     )
-    if count == 0:
-        await db.execute(
-            "INSERT INTO user_variables (user_id, variable, value) VALUES (?, ?, ?)",
-            (user_id, variable, value),
-        )
 
 
 async def send_email(to_addr: str, subject: str, body: str) -> None:
@@ -1300,8 +1637,10 @@ async def v1_sensorunit_ports_output_on(serialnumber: Optional[str] = None, port
     else:
         new_status = f"{parts[0]},{parts[1]},3,{updated}"
     reply = await send_sms_with_linkmobility(phone, f"Start {port}")
-    await dbupdate_variable(serialnumber, "remotecontroller_status", new_status)
-    await dbupdate_variable(serialnumber, "remotecontroller_reply", reply or "")
+    async with db.transaction():
+        await dbupdate_variable(serialnumber, "remotecontroller_status", new_status)
+        await dbupdate_variable(serialnumber, "remotecontroller_reply", reply or "")
+    await invalidation.publish("sensorunit_variables")
     return {"result": reply}
 
 
@@ -1321,8 +1660,10 @@ async def v1_sensorunit_ports_output_off(serialnumber: Optional[str] = None, por
     else:
         new_status = f"{parts[0]},{parts[1]},4,{updated}"
     reply = await send_sms_with_linkmobility(phone, f"Stop {port}")
-    await dbupdate_variable(serialnumber, "remotecontroller_status", new_status)
-    await dbupdate_variable(serialnumber, "remotecontroller_reply", reply or "")
+    async with db.transaction():
+        await dbupdate_variable(serialnumber, "remotecontroller_status", new_status)
+        await dbupdate_variable(serialnumber, "remotecontroller_reply", reply or "")
+    await invalidation.publish("sensorunit_variables")
     return {"result": reply}
 
 
@@ -1381,61 +1722,46 @@ async def v1_customers_add(
     if not customernumber:
         raise HTTPException(status_code=400, detail="Missing parameter: needs customernumber")
 
-    row = await db.fetchone(
-        "SELECT customernumber FROM customer WHERE customernumber=?",
-        (customernumber,),
-    )
-    if row:
+    created = await db.insert_unique(
+        "customer",
+        ("customernumber",),
+        {
+            "customernumber": customernumber,
+            "customer_name": customer_name or "",
+            "customer_vatnumber": customer_vatnumber or "",
+            "customer_phone": customer_phone or "",
+            "customer_fax": customer_fax or "",
+            "customer_email": customer_email or "",
+            "customer_web": customer_web or "",
+            "customer_visitaddr1": customer_visitaddr1 or "",
+            "customer_visitaddr2": customer_visitaddr2 or "",
+            "customer_visitpostcode": customer_visitpostcode or "",
+            "customer_visitcity": customer_visitcity or "",
+            "customer_visitcountry": customer_visitcountry or "0",
+            "customer_invoiceaddr1": customer_invoiceaddr1 or "",
+            "customer_invoiceaddr2": customer_invoiceaddr2 or "",
+            "customer_invoicepostcode": customer_invoicepostcode or "",
+            "customer_invoicecity": customer_invoicecity or "",
+            "customer_invoicecountry": customer_invoicecountry or "0",
+            "customer_deliveraddr1": customer_deliveraddr1 or "",
+            "customer_deliveraddr2": customer_deliveraddr2 or "",
+            "customer_deliverpostcode": customer_deliverpostcode or "",
+            "customer_delivercity": customer_delivercity or "",
+            "customer_delivercountry": customer_delivercountry or "0",
+            "customer_maincontact": customer_maincontact or "",
+            "customer_deliveraddr_same_as_invoice": customer_deliveraddr_same_as_invoice or "false",
+            "customer_invoiceaddr_same_as_visit": customer_invoiceaddr_same_as_visit or "false",
+            "customertype_id_ref": customertype_id_ref or 1,
+            "customer_site_title": customer_site_title or "",
+            "dealer_id": dealer_id or 0,
+        },
+    )
+    if not created:
         raise HTTPException(
             status_code=302,
             detail=f"Record exists for customernumber:{customernumber}",
         )
-
-    await db.execute(
-        """
-        INSERT INTO customer (
-            customernumber,customer_name,customer_vatnumber,customer_phone,
-            customer_fax,customer_email,customer_web,customer_visitaddr1,
-            customer_visitaddr2,customer_visitpostcode,customer_visitcity,
-            customer_visitcountry,customer_invoiceaddr1,customer_invoiceaddr2,
-            customer_invoicepostcode,customer_invoicecity,customer_invoicecountry,
-            customer_deliveraddr1,customer_deliveraddr2,customer_deliverpostcode,
-            customer_delivercity,customer_delivercountry,customer_maincontact,
-            customer_deliveraddr_same_as_invoice,customer_invoiceaddr_same_as_visit,
-            customertype_id_ref,customer_site_title,dealer_id
-        ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-        """,
-        (
-            customernumber,
-            customer_name or "",
-            customer_vatnumber or "",
-            customer_phone or "",
-            customer_fax or "",
-            customer_email or "",
-            customer_web or "",
-            customer_visitaddr1 or "",
-            customer_visitaddr2 or "",
-            customer_visitpostcode or "",
-            customer_visitcity or "",
-            customer_visitcountry or "0",
-            customer_invoiceaddr1 or "",
-            customer_invoiceaddr2 or "",
-            customer_invoicepostcode or "",
-            customer_invoicecity or "",
-            customer_invoicecountry or "0",
-            customer_deliveraddr1 or "",
-            customer_deliveraddr2 or "",
-            customer_deliverpostcode or "",
-            customer_delivercity or "",
-            customer_delivercountry or "0",
-            customer_maincontact or "",
-            customer_deliveraddr_same_as_invoice or "false",
-            customer_invoiceaddr_same_as_visit or "false",
-            customertype_id_ref or 1,
-            customer_site_title or "",
-            dealer_id or 0,
-        ),
-    )
+    await invalidation.publish("customer")
     return {"result": "OK"}
 
 
@@ -1575,6 +1901,7 @@ async def v1_customers_update(
     )
     if rowcount == 0:
         raise HTTPException(status_code=404, detail="No record for customer")
+    await invalidation.publish("customer")
     return {"result": "OK"}
 
 
@@ -1630,6 +1957,7 @@ async def v1_document_add(
         "INSERT INTO documents (document_name, document_url, document_language, document_version, serialnumber) VALUES (?, ?, ?, ?, ?)",
         (document_name, document_url, document_language or "", document_version or "", serialnumber),
     )
+    await invalidation.publish("documents")
     return {"result": "OK"}
 
 
@@ -1641,6 +1969,7 @@ async def v1_document_delete(document_id: Optional[int] = None):
     rowcount = await db.execute("DELETE FROM documents WHERE document_id=?", (document_id,))
     if rowcount == 0:
         raise HTTPException(status_code=404, detail=f"No document id for id:{document_id}")
+    await invalidation.publish("documents")
     return {"message": "OK"}
 
 
@@ -1650,24 +1979,42 @@ async def v1_irrigation_runlog_list(
     offset: Optional[int] = None,
     serialnumber: Optional[str] = None,
     sortfield: Optional[str] = None,
+    after: Optional[str] = None,
 ):
-    """List irrigation run log entries."""
+    """List irrigation run log entries.
+
+    Without ``sortfield`` entries are ordered by ``irrigation_run_id`` and a
+    ``next`` cursor is returned for use as ``after`` on the following call.
+    """
     if not serialnumber:
         raise HTTPException(status_code=400, detail="Missing parameter, needs serialnumber")
+    if after and sortfield:
+        raise HTTPException(status_code=400, detail="Parameter after can not be combined with sortfield")
     query = (
         "SELECT serialnumber,irrigation_starttime,irrigation_endtime,irrigation_startpoint,irrigation_endpoint,irrigation_nozzlewidth,irrigation_nozzlebar,irrigation_run_id,irrigation_note,hidden,irrigation_nozzleadjustment,portal_endpoint FROM irrigation_log WHERE serialnumber=?"
     )
     params: list = [serialnumber]
+    keyset = ["irrigation_run_id"]
+    keyset_types = (int,)
+    if after:
+        clause, values = keyset_where(keyset, after, descending=False, types=keyset_types)
+        query += f" AND {clause}"
+        params.extend(values)
     if sortfield:
         query += f" ORDER BY {sortfield}"
+    else:
+        query += keyset_order(keyset, descending=False)
     if limit is not None:
         query += " LIMIT ?"
         params.append(limit)
     if offset is not None:
         query += " OFFSET ?"
         params.append(offset)
-    rows = await db.fetchall(query, tuple(params))
-    return {"result": rows}
+    path = "/v1/irrigation/runlog/list"
+    rows = await db.fetchall(query, tuple(params), records=fast_json(path))
+    if sortfield:
+        return result_response(path, rows)
+    return result_response(path, rows, next=keyset_next(rows, keyset, limit))
 
 
 @app.patch("/v1/irrigation/runlog/update")
@@ -1718,6 +2065,7 @@ async def v1_products_delete(productnumber: Optional[str] = None, product_id: Op
     rowcount = await db.execute(f"DELETE FROM products WHERE {where}", (param,))
     if rowcount == 0:
         raise HTTPException(status_code=404, detail=f"No record for for productnumber:{productnumber} or product_id:{product_id}")
+    await invalidation.publish("products", keys=[productnumber or str(product_id)])
     return {"message": "OK"}
 
 
@@ -1806,6 +2154,7 @@ async def v1_products_update(
                 document_id_ref,
             ),
         )
+    await invalidation.publish("products", keys=[productnumber])
     return {"result": "OK"}
 
 
@@ -1830,7 +2179,7 @@ async def v1_products_type_list(
     if offset is not None:
         query += " OFFSET ?"
         params.append(offset)
-    rows = await db.fetchall(query, tuple(params))
+    rows = await reference_cache.fetchall(db, "products_type", query, tuple(params))
     return {"result": rows}
 
 
@@ -1846,6 +2195,7 @@ async def v1_products_type_add(
         "INSERT INTO products_type (product_type_name, product_type_description) VALUES (?, ?)",
         (product_type_name, product_type_description or ""),
     )
+    await invalidation.publish("products_type")
     return {"result": "OK"}
 
 
@@ -1878,6 +2228,7 @@ async def v1_products_type_update(
             "INSERT INTO products_type (product_type_name, product_type_description) VALUES (?, ?)",
             (product_type_name or "", product_type_description or ""),
         )
+    await invalidation.publish("products_type")
     return {"result": "OK"}
 
 
@@ -1892,6 +2243,7 @@ async def v1_products_type_delete(product_type_id: Optional[int] = None):
     )
     if rowcount == 0:
         raise HTTPException(status_code=404, detail=f"No record for product_type_id:{product_type_id}")
+    await invalidation.publish("products_type")
     return {"message": "OK"}
 
 
@@ -1963,24 +2315,28 @@ async def v1_sensorprobes_update(
             status_code=400,
             detail="Missing parameter: needs product_id_ref, sensorprobes_number and unittype_id_ref",
         )
-    updates = ["unittype_id_ref=?"]
-    params: list = [unittype_id_ref]
-    if sensorprobes_url is not None:
-        updates.append("sensorprobes_url=?")
-        params.append(sensorprobes_url)
-    if sensorprobes_alert_hidden is not None:
-        updates.append("sensorprobes_alert_hidden=?")
-        params.append(sensorprobes_alert_hidden)
-    params.extend([product_id_ref, sensorprobes_number])
-    rowcount = await db.execute(
-        f"UPDATE sensorprobes SET {', '.join(updates)} WHERE product_id_ref=? AND sensorprobes_number=?",
-        tuple(params),
-    )
-    if rowcount == 0:
-        await db.execute(
-            "INSERT INTO sensorprobes (product_id_ref, sensorprobes_number, unittype_id_ref, sensorprobes_url, sensorprobes_alert_hidden) VALUES (?, ?, ?, ?, ?)",
-            (product_id_ref, sensorprobes_number, unittype_id_ref, sensorprobes_url or "", sensorprobes_alert_hidden or ""),
-        )
+    values = {
+        "product_id_ref": product_id_ref,
+        "sensorprobes_number": sensorprobes_number,
+        "unittype_id_ref": unittype_id_ref,
+    }
+    insert_values = {}
+    for column, value in [
+        ("sensorprobes_url", sensorprobes_url),
+        ("sensorprobes_alert_hidden", sensorprobes_alert_hidden),
+    ]:
+        # Only overwrite optional fields that were given; new rows default to ""
+        if value is not None:
+            values[column] = value
+        else:
+            insert_values[column] = ""
+    await db.upsert(
+        "sensorprobes",
+        ("product_id_ref", "sensorprobes_number"),
+        values,
+        insert_values=insert_values,
+    )
+    await invalidation.publish("sensorprobes")
     return {"result": "OK"}
 
 
@@ -2006,6 +2362,7 @@ async def v1_sensorprobes_delete(
             status_code=404,
             detail=f"No record for product_id_ref:{product_id_ref}, sensorprobes_number:{sensorprobes_number}",
         )
+    await invalidation.publish("sensorprobes")
     return {"message": "OK"}
 
 
@@ -2058,15 +2415,18 @@ async def v1_sensorprobes_variable_update(
             status_code=400,
             detail="Missing parameter: needs serialnumber, sensorprobe_number, variable and value",
         )
-    rowcount = await db.execute(
-        "UPDATE sensorprobe_variables SET value=?, dateupdated=CURRENT_TIMESTAMP WHERE serialnumber=? AND sensorprobe_number=? AND variable=?",
-        (value, serialnumber, sensorprobe_number, variable),
-    )
-    if rowcount == 0:
-        await db.execute(
-            "INSERT INTO sensorprobe_variables (serialnumber, sensorprobe_number, variable, value, dateupdated) VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)",
-            (serialnumber, sensorprobe_number, variable, value),
-        )
+    await db.upsert(
+        "sensorprobe_variables",
+        ("serialnumber", "sensorprobe_number", "variable"),
+        {
+            "serialnumber": serialnumber,
+            "sensorprobe_number": sensorprobe_number,
+            "variable": variable,
+            "value": value,
+        },
+        now_columns=("dateupdated",),
+    )
+    await invalidation.publish("sensorprobe_variables")
     return {"result": "OK"}
 
 
@@ -2091,6 +2451,7 @@ async def v1_sensorprobes_variable_delete(
             status_code=404,
             detail=f"No record for serialnumber:{serialnumber}, sensorprobe_number:{sensorprobe_number} variable:{variable}",
         )
+    await invalidation.publish("sensorprobe_variables")
     return {"message": "OK"}
 
 
@@ -2111,11 +2472,13 @@ async def v1_sensorunits_access_grant(
     if row is None:
         raise HTTPException(status_code=400, detail=f"User with email:{user_email} is not found")
     uid = row["user_id"]
-    await db.execute("DELETE FROM sensoraccess WHERE user_id=? AND serialnumber=?", (uid, serialnumber))
-    await db.execute(
-        "INSERT INTO sensoraccess (user_id, serialnumber, changeallowed) VALUES (?, ?, ?)",
-        (uid, serialnumber, changeallowed),
-    )
+    async with db.transaction() as tx:
+        await tx.execute("DELETE FROM sensoraccess WHERE user_id=? AND serialnumber=?", (uid, serialnumber))
+        await tx.execute(
+            "INSERT INTO sensoraccess (user_id, serialnumber, changeallowed) VALUES (?, ?, ?)",
+            (uid, serialnumber, changeallowed),
+        )
+    await invalidation.publish("sensoraccess", keys=[f"{uid}:{serialnumber}"])
     return {"message": "OK"}
 
 
@@ -2144,6 +2507,7 @@ async def v1_sensorunits_access_delete(
             status_code=404,
             detail=f"No record for user_email:{user_email} and serialnumber={serialnumber}.",
         )
+    await invalidation.publish("sensoraccess", keys=[f"{uid}:{serialnumber}"])
     return {"message": "OK"}
 
 
@@ -2152,19 +2516,13 @@ async def v1_sensorunits_access_list(
     serialnumber: Optional[str] = None,
     user_id: Optional[int] = None,
 ):
-    """List sensorunit access records."""
+    """List sensorunit access records from the in-memory access index."""
     if not serialnumber and user_id is None:
         raise HTTPException(status_code=400, detail="Missing parameter: needs serialnumber user_id")
     if serialnumber:
-        rows = await db.fetchall(
-            "SELECT serialnumber,user_id,changeallowed FROM sensoraccess WHERE serialnumber=?",
-            (serialnumber,),
-        )
+        rows = await sensor_access.grants_for_serial(serialnumber)
     else:
-        rows = await db.fetchall(
-            "SELECT serialnumber,user_id,changeallowed FROM sensoraccess WHERE user_id=?",
-            (user_id,),
-        )
+        rows = await sensor_access.grants_for_user(user_id)
     return {"result": rows}
 
 
@@ -2194,34 +2552,26 @@ async def v1_sensorunits_add(
             status_code=400,
             detail="Missing parameter: needs at least serialnumber, dbname, product_id_ref, customer_id_ref, helpdesk_id_ref",
         )
-    existing = await db.fetchone(
-        "SELECT serialnumber FROM sensorunits WHERE serialnumber=?",
-        (serialnumber,),
-    )
-    if existing:
+    created = await db.insert_unique(
+        "sensorunits",
+        ("serialnumber",),
+        {
+            "serialnumber": serialnumber,
+            "dbname": dbname,
+            "product_id_ref": product_id_ref,
+            "customer_id_ref": customer_id_ref,
+            "helpdesk_id_ref": helpdesk_id_ref,
+            "sensorunit_installdate": sensorunit_installdate,
+            "sensorunit_lastconnect": sensorunit_lastconnect,
+            "sensorunit_location": sensorunit_location,
+            "sensorunit_note": sensorunit_note,
+            "sensorunit_position": sensorunit_position,
+            "sensorunit_status": sensorunit_status,
+        },
+    )
+    if not created:
         raise HTTPException(status_code=302, detail=f"Record exists for serialnumber:{serialnumber}")
-    await db.execute(
-        """
-        INSERT INTO sensorunits (
-            serialnumber, dbname, product_id_ref, customer_id_ref, helpdesk_id_ref,
-            sensorunit_installdate, sensorunit_lastconnect, sensorunit_location,
-            sensorunit_note, sensorunit_position, sensorunit_status
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """,
-        (
-            serialnumber,
-            dbname,
-            product_id_ref,
-            customer_id_ref,
-            helpdesk_id_ref,
-            sensorunit_installdate,
-            sensorunit_lastconnect,
-            sensorunit_location,
-            sensorunit_note,
-            sensorunit_position,
-            sensorunit_status,
-        ),
-    )
+    await invalidation.publish("sensorunits", keys=[serialnumber])
     return {"result": "OK"}
 
 
@@ -2276,6 +2626,7 @@ async def v1_sensorunits_update(
             status_code=404,
             detail=f"Missing record for serialnumber:{serialnumber}",
         )
+    await invalidation.publish("sensorunits", keys=[serialnumber])
     return {"result": "OK"}
 
 
@@ -2299,6 +2650,7 @@ async def v1_sensorunits_delete(
             status_code=404,
             detail=f"No record for for serialnumber:{serialnumber} or sensorunit_id:{sensorunit_id}.",
         )
+    await invalidation.publish("sensorunits", keys=None if sensorunit_id is not None else [serialnumber])
     return {"message": "OK"}
 
 
@@ -2309,25 +2661,20 @@ async def v1_sensorunits_list(
     productnumber: Optional[str] = None,
     sortfield: Optional[str] = None,
 ):
-    """List sensorunits for a user."""
-    query = (
-        "SELECT sensoraccess.serialnumber, sensoraccess.changeallowed, sensoraccess.user_id, "
-        "products.product_name, products.product_description, products.productnumber, "
-        "products.product_type, products.product_image_url, sensorunits.sensorunit_installdate, "
-        "sensorunits.sensorunit_lastconnect, sensorunits.sensorunit_location, sensorunits.sensorunit_xpos, "
-        "sensorunits.sensorunit_zpos, sensorunits.sensorunit_status, sensorunits.block, "
-        "customertype.description, customertype.customertype, products.product_id, customertype.customertype_id, "
-        "sensorunits.sensorunit_ypos, sensorunits.sensorunit_note, customer.customernumber, customer.customer_name, "
-        "customer.customer_site_title, customer.customer_id, customer.customer_maincontact, documents.document_url, "
-        "documents.document_name, helpdesks.helpdesk_phone, helpdesks.helpdesk_email "
-        "FROM sensoraccess "
-        "INNER JOIN sensorunits ON (sensoraccess.serialnumber = sensorunits.serialnumber) "
-        "INNER JOIN products ON (sensorunits.product_id_ref = products.product_id) "
-        "INNER JOIN customer ON (sensorunits.customer_id_ref = customer.customer_id) "
-        "INNER JOIN customertype ON (customer.customertype_id_ref = customertype.customertype_id) "
-        "INNER JOIN documents ON (products.document_id_ref=documents.document_id) "
-        "INNER JOIN helpdesks ON (sensorunits.helpdesk_id_ref = helpdesks.helpdesk_id)"
-    )
+    """List sensorunits for a user.
+
+    With ``user_id`` and no ``sortfield`` the rows come from the materialized
+    per-user list (``user_sensorunits``) instead of the seven table join.
+    """
+    path = "/v1/sensorunits/list"
+    if user_id is not None and not sortfield:
+        rows = await user_sensorunits.get(user_id)
+        if serialnumber:
+            rows = [r for r in rows if r["serialnumber"] == serialnumber]
+        if productnumber:
+            rows = [r for r in rows if r["serialnumber"][:10] == productnumber]
+        return result_response(path, rows)
+    query = SENSORUNITS_LIST_QUERY
     clauses = []
     params: list = []
     if user_id is not None:
@@ -2343,8 +2690,8 @@ async def v1_sensorunits_list(
         query += " WHERE " + " AND ".join(clauses)
     if sortfield:
         query += f" ORDER BY {sortfield}"
-    rows = await db.fetchall(query, tuple(params))
-    return {"result": rows}
+    rows = await db.fetchall(query, tuple(params), records=fast_json(path))
+    return result_response(path, rows)
 
 
 @app.get("/v1/sensorunits/units/list")
@@ -2415,19 +2762,17 @@ async def v1_sensorunits_variable_add(
             status_code=400,
             detail="Missing parameter: needs serialnumber and variable",
         )
-    existing = await db.fetchone(
-        "SELECT serialnumber FROM sensorunit_variables WHERE serialnumber=? AND variable=?",
-        (serialnumber, variable),
+    created = await db.insert_unique(
+        "sensorunit_variables",
+        ("serialnumber", "variable"),
+        {"serialnumber": serialnumber, "variable": variable, "value": value or "0"},
     )
-    if existing:
+    if not created:
         raise HTTPException(
             status_code=302,
             detail=f"Record exists for serialnumber:{serialnumber} and variable:{variable}",
         )
-    await db.execute(
-        "INSERT INTO sensorunit_variables (serialnumber, variable, value) VALUES (?, ?, ?)",
-        (serialnumber, variable, value or "0"),
-    )
+    await invalidation.publish("sensorunit_variables")
     return {"result": "OK"}
 
 
@@ -2443,15 +2788,8 @@ async def v1_sensorunits_variable_update(
             status_code=400,
             detail="Missing parameter: needs serialnumber and variable",
         )
-    rowcount = await db.execute(
-        "UPDATE sensorunit_variables SET value=? WHERE serialnumber=? AND variable=?",
-        (value or "0", serialnumber, variable),
-    )
-    if rowcount == 0:
-        await db.execute(
-            "INSERT INTO sensorunit_variables (serialnumber, variable, value) VALUES (?, ?, ?)",
-            (serialnumber, variable, value or "0"),
-        )
+    await dbupdate_variable(serialnumber, variable, value or "0")
+    await invalidation.publish("sensorunit_variables")
     return {"result": "OK"}
 
 
@@ -2477,6 +2815,7 @@ async def v1_sensorunits_variable_delete(
             status_code=404,
             detail=f"No record for serialnumber:{serialnumber}.",
         )
+    await invalidation.publish("sensorunit_variables")
     return {"result": "OK"}
 
 
@@ -2537,7 +2876,7 @@ async def v1_unittypes_list(
     if offset is not None:
         query += " OFFSET ?"
         params.append(offset)
-    rows = await db.fetchall(query, tuple(params))
+    rows = await reference_cache.fetchall(db, "unittypes", query, tuple(params))
     return {"result": rows}
 
 
@@ -2584,6 +2923,7 @@ async def v1_unittypes_update(
                 unittype_decimals or 0,
             ),
         )
+    await invalidation.publish("unittypes")
     return {"result": "OK"}
 
 
@@ -2598,9 +2938,70 @@ async def v1_unittypes_delete(unittype_id: Optional[int] = None):
     )
     if rowcount == 0:
         raise HTTPException(status_code=404, detail=f"No record for unittype_id:{unittype_id}")
+    await invalidation.publish("unittypes")
     return {"message": "OK"}
 
 
+def _cursor_default(value):
+    if isinstance(value, datetime.datetime):
+        return {"$dt": value.isoformat()}
+    return json_default(value)
+
+
+def _cursor_hook(obj: dict):
+    if "$dt" in obj:
+        return datetime.datetime.fromisoformat(obj["$dt"])
+    return obj
+
+
+def encode_cursor(values: list) -> str:
+    """Encode the keyset values of the last row into an opaque ``after`` token."""
+    raw = json.dumps(values, default=_cursor_default, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, types: tuple[type, ...]) -> list:
+    """Decode an ``after`` token, checking it holds one value of each of ``types``."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw, object_hook=_cursor_hook)
+    except (binascii.Error, TypeError, ValueError):
+        values = None
+    if (
+        not isinstance(values, list)
+        or len(values) != len(types)
+        or any(isinstance(v, bool) or not isinstance(v, t) for v, t in zip(values, types))
+    ):
+        raise HTTPException(status_code=400, detail=f"Invalid cursor: {cursor}")
+    return values
+
+
+def keyset_where(
+    columns: list[str], after: str, descending: bool, types: tuple[type, ...]
+) -> tuple[str, list]:
+    """Return a row-comparison predicate selecting rows after the ``after`` cursor.
+
+    The comparison is written as ``(a, b) < (?, ?)`` so Postgres can use a
+    composite index instead of skipping ``OFFSET`` rows. ``types`` are the
+    Python types of the columns, used to reject forged cursors.
+    """
+    values = decode_cursor(after, types)
+    op = "<" if descending else ">"
+    return f"({', '.join(columns)}) {op} ({', '.join('?' * len(columns))})", values
+
+
+def keyset_order(columns: list[str], descending: bool) -> str:
+    direction = " DESC" if descending else ""
+    return " ORDER BY " + ", ".join(f"{c}{direction}" for c in columns)
+
+
+def keyset_next(rows: list[dict], keys: list[str], limit: Optional[int]) -> Optional[str]:
+    """Return the ``after`` cursor for the next page, or ``None`` on the last page."""
+    if limit is None or not rows or len(rows) < limit:
+        return None
+    return encode_cursor([rows[-1][k] for k in keys])
+
+
 @app.get("/v1/sensorunits/data")
 async def v1_sensorunits_data(
     serialnumber: Optional[str] = None,
@@ -2608,6 +3009,18 @@ async def v1_sensorunits_data(
     offset: Optional[int] = None,
     probenumber: Optional[int] = None,
     sortfield: Optional[str] = None,
+    stream: Optional[str] = None,
+    after: Optional[str] = None,
+    format: Optional[str] = None,
+    epoch: bool = False,
+    bucket: Optional[str] = None,
+    agg: Optional[str] = None,
+    points: Optional[int] = None,
+    timestart: Optional[str] = None,
+    timestop: Optional[str] = None,
+    days: Optional[float] = None,
+    unittype: Optional[int] = None,
+    timezone: Optional[str] = None,
 ):
     """List sensordata entries for a sensor unit.
 
@@ -2615,52 +3028,270 @@ async def v1_sensorunits_data(
     fetch the data we first look up the correct database for the provided
     ``serialnumber`` from the ``sensorunits`` table in the main database.
     The query is then executed against that customer specific sensordata
-    database.
+    database. Pools for the customer databases are kept open in
+    ``sensordbs`` so repeated calls do not reconnect.
+
+    With ``stream=ndjson`` (one JSON object per line) or ``stream=json``
+    (the usual ``{"result": [...]}`` document, sent in chunks) rows are read
+    through a server-side cursor and written as they arrive instead of being
+    collected in memory first.
+
+    Without ``sortfield`` rows are returned newest first. When ``limit`` is
+    set the response carries a ``next`` cursor which can be passed back as
+    ``after`` to fetch the following page without ``OFFSET``.
+
+    ``format=columnar`` returns one array per column instead of one object
+    per row; add ``epoch=true`` to get timestamps as Unix seconds.
+
+    As in the Perl version the rows can be limited to ``timestart`` ..
+    ``timestop`` (ISO 8601 or Unix seconds), to the last ``days`` days and to
+    the probes of ``unittype`` on the unit's product. ``timezone`` (``+01``,
+    ``Europe/Oslo``) adds an ``epoch`` column with the timestamps read as
+    local time in that zone.
+
+    For charts the data can be reduced in the database or before sending:
+
+    * ``bucket`` (``30s``, ``15m``, ``1h``, ``1d``) returns one row per probe
+      and time bucket, with ``timestamp`` set to the start of the bucket and
+      one column per aggregate in ``agg`` (``min``, ``max``, ``avg``,
+      ``first``, ``last``, ``count``; default ``avg``). ``limit`` and
+      ``offset`` count buckets.
+    * ``points`` returns at most that many rows per probe, picked with the
+      largest triangle three buckets algorithm so peaks are kept. It needs
+      ``timestart`` or ``days`` to bound the rows that are read.
     """
     if not serialnumber:
         raise HTTPException(
             status_code=400, detail="Missing parameter: needs serialnumber"
         )
+    if stream is not None and stream not in STREAM_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail="Parameter stream must be ndjson or json")
+    if after and sortfield:
+        raise HTTPException(status_code=400, detail="Parameter after can not be combined with sortfield")
+    check_format(format)
+    if stream and format == "columnar":
+        raise HTTPException(status_code=400, detail="Parameter stream can not be combined with format=columnar")
+    if (bucket or points is not None) and (after or sortfield or stream):
+        raise HTTPException(
+            status_code=400, detail="Parameters bucket and points can not be combined with after, sortfield or stream"
+        )
+    if agg and not bucket:
+        raise HTTPException(status_code=400, detail="Parameter agg needs bucket")
+    if points is not None and (bucket or limit is not None or offset is not None):
+        raise HTTPException(status_code=400, detail="Parameter points can not be combined with bucket, limit or offset")
+    if points is not None and points < 3:
+        raise HTTPException(status_code=400, detail="Parameter points must be at least 3")
+    if points is not None and not timestart and days is None:
+        # Downsampling reads every row of the range into memory
+        raise HTTPException(status_code=400, detail="Missing parameter: points needs timestart or days")
+    time_range, time_params = sensordata_range(timestart, timestop, days)
+    if timezone and not TIMEZONE_PATTERN.fullmatch(timezone):
+        raise HTTPException(status_code=400, detail="Parameter timezone must be an offset like +01 or a zone name")
+    if timezone and bucket:
+        raise HTTPException(status_code=400, detail="Parameter timezone can not be combined with bucket")
 
     # Look up the sensor specific database name from the main database
-    row = await db.fetchone(
-        "SELECT dbname FROM sensorunits WHERE serialnumber=?", (serialnumber,)
-    )
-    if row is None or not row.get("dbname"):
+    unit = await sensorunit_index.get(serialnumber)
+    if unit is None or not unit.dbname:
         raise HTTPException(
             status_code=400,
             detail=f"Did not find customer DB for serialnumber:{serialnumber}",
         )
-    sensor_db_name = row["dbname"].strip()
+    sensor_db_name = unit.dbname
+    path = "/v1/sensorunits/data"
 
-    # Connect to the customer specific database and run the query there
-    sensordb = PortalDB(
-        dsn=f"dbi:Pg:dbname={sensor_db_name};host=localhost;port=5432"
-    )
-    await sensordb.connect()
-    try:
+    where = "serialnumber=?"
+    where_params: list = [serialnumber]
+    if probenumber is not None:
+        where += " AND probenumber=?"
+        where_params.append(probenumber)
+    if unittype is not None:
+        probes = await reference_cache.fetchall(db, "sensorprobes", UNITTYPE_PROBES_QUERY, (unit.product_id, unittype))
+        where += " AND probenumber = ANY(?)"
+        where_params.append([r["sensorprobes_number"] for r in probes])
+    where += time_range
+    where_params.extend(time_params)
+
+    if bucket:
+        seconds = parse_bucket(bucket)
+        aggregates = parse_aggregates(agg)
+        # Naive UTC timestamps, like the raw rows
         query = (
-            "SELECT probenumber, sequencenumber, value, timestamp "
-            "FROM sensordata WHERE serialnumber=?"
-        )
-        params: list = [serialnumber]
-        if probenumber is not None:
-            query += " AND probenumber=?"
-            params.append(probenumber)
-        if sortfield:
-            query += f" ORDER BY {sortfield}"
+            "SELECT probenumber, "
+            "to_timestamp(floor(extract(epoch FROM timestamp)::float8 / ?) * ?) AT TIME ZONE 'UTC' AS timestamp, "
+            + ", ".join(f"{SENSORDATA_AGGREGATES[name]} AS {name}" for name in aggregates)
+            + f" FROM sensordata WHERE {where}"
+        )
+        params: list = [seconds, seconds, *where_params]
+        query += " GROUP BY probenumber, 2 ORDER BY probenumber, 2"
         if limit is not None:
             query += " LIMIT ?"
             params.append(limit)
         if offset is not None:
             query += " OFFSET ?"
             params.append(offset)
+        async with sensordbs.lease(sensor_db_name) as sensordb:
+            rows = await sensordb.fetchall(query, tuple(params), records=fast_json(path))
+        return result_response(path, format_rows(rows, format, ["probenumber", "timestamp", *aggregates], epoch))
 
-        rows = await sensordb.fetchall(query, tuple(params))
-    finally:
-        await sensordb.close()
+    columns = ["probenumber", "sequencenumber", "value", "timestamp"]
+    query = "SELECT probenumber, sequencenumber, value, timestamp"
+    params: list = []
+    if timezone:
+        query += ", extract(epoch FROM timestamp AT TIME ZONE ?)::bigint AS epoch"
+        params.append(timezone)
+        columns.append("epoch")
+    query += f" FROM sensordata WHERE {where}"
+    params.extend(where_params)
+    keyset = ["timestamp", "probenumber"]
+    keyset_types = (datetime.datetime, int)
+    if after:
+        clause, values = keyset_where(keyset, after, descending=True, types=keyset_types)
+        query += f" AND {clause}"
+        params.extend(values)
+    if points is not None:
+        query += " ORDER BY probenumber, timestamp"
+        async with sensordbs.lease(sensor_db_name) as sensordb:
+            rows = await sensordb.fetchall(query, tuple(params), records=fast_json(path))
+        rows = downsample(rows, points)
+        return result_response(path, format_rows(rows, format, columns, epoch))
+    if sortfield:
+        query += f" ORDER BY {sortfield}"
+    else:
+        query += keyset_order(keyset, descending=True)
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
+    if offset is not None:
+        query += " OFFSET ?"
+        params.append(offset)
 
-    return {"result": rows}
+    if stream:
+        # Lease the pool and read the first rows before the status is sent, so
+        # pool and statement timeouts are still answered with 503/504. The
+        # body iterator releases both when it ends.
+        resources = contextlib.AsyncExitStack()
+        try:
+            sensordb = await resources.enter_async_context(sensordbs.lease(sensor_db_name))
+            cursor = sensordb.stream(query, tuple(params))
+            resources.push_async_callback(cursor.aclose)
+            first = [await cursor.__anext__()]
+        except StopAsyncIteration:
+            first = []
+        except BaseException:
+            await resources.aclose()
+            raise
+
+        async def cursor_rows() -> AsyncIterator[dict]:
+            try:
+                for r in first:
+                    yield r
+                async for r in cursor:
+                    yield r
+            finally:
+                await resources.aclose()
+
+        return StreamingResponse(
+            stream_json_rows(cursor_rows(), stream), media_type=STREAM_MEDIA_TYPES[stream]
+        )
+
+    # Run the query against the customer specific database pool
+    async with sensordbs.lease(sensor_db_name) as sensordb:
+        rows = await sensordb.fetchall(query, tuple(params), records=fast_json(path))
+
+    result = format_rows(rows, format, columns, epoch)
+    if sortfield:
+        return result_response(path, result)
+    return result_response(path, result, next=keyset_next(rows, keyset, limit))
+
+
+@app.get("/v1/sensorunits/data/batch")
+async def v1_sensorunits_data_batch(
+    serialnumbers: Optional[str] = None,
+    probenumber: Optional[int] = None,
+    timestart: Optional[str] = None,
+    timestop: Optional[str] = None,
+    days: Optional[float] = None,
+):
+    """List sensordata for many sensor units in one request.
+
+    ``serialnumbers`` is a comma separated list. The units are grouped by
+    their customer database and each database is queried once with
+    ``serialnumber = ANY(...)``; up to ``PORTAL_BATCH_CONCURRENCY`` databases
+    are queried at the same time. ``timestart``, ``timestop`` and ``days``
+    work as for ``/v1/sensorunits/data`` and one of ``timestart`` or ``days``
+    is required.
+
+    The response is ``{"missing": [...], "result": {serialnumber: rows}}``,
+    streamed one database at a time as the queries finish. ``missing``
+    lists serialnumbers without a customer database. If the query of a
+    database fails, its units are left out of ``result`` and listed in a
+    trailing ``"errors": {serialnumber: detail}`` instead, since the status
+    code has been sent by then.
+    """
+    serials = list(dict.fromkeys(s.strip() for s in (serialnumbers or "").split(",") if s.strip()))
+    if not serials:
+        raise HTTPException(status_code=400, detail="Missing parameter: needs serialnumbers")
+    if not timestart and days is None:
+        raise HTTPException(status_code=400, detail="Missing parameter: needs timestart or days")
+    time_range, time_params = sensordata_range(timestart, timestop, days)
+
+    groups: dict[str, list[str]] = {}
+    missing = []
+    for serial, unit in (await sensorunit_index.get_many(serials)).items():
+        if unit is None or not unit.dbname:
+            missing.append(serial)
+        else:
+            groups.setdefault(unit.dbname, []).append(serial)
+
+    query = (
+        "SELECT serialnumber, probenumber, sequencenumber, value, timestamp "
+        "FROM sensordata WHERE serialnumber = ANY(?)"
+    )
+    params: list = []
+    if probenumber is not None:
+        query += " AND probenumber=?"
+        params.append(probenumber)
+    query += time_range + " ORDER BY serialnumber, timestamp DESC, probenumber DESC"
+    params.extend(time_params)
+    limiter = asyncio.Semaphore(SENSORDATA_BATCH_CONCURRENCY)
+    errors: dict[str, str] = {}
+
+    async def fetch_group(dbname: str, group: list[str]) -> dict:
+        try:
+            async with limiter:
+                async with sensordbs.lease(dbname) as sensordb:
+                    rows = await sensordb.fetchall(query, (group, *params), records=True)
+        except PoolTimeoutError:
+            detail = "Database busy, try again later"
+        except StatementTimeoutError:
+            detail = "Query timed out"
+        except Exception:
+            logging.exception("Sensordata batch query on %s failed", dbname)
+            detail = "Query failed"
+        else:
+            by_serial: dict = {serial: [] for serial in group}
+            for serial, group_rows in itertools.groupby(rows, key=lambda r: r["serialnumber"]):
+                by_serial[serial] = list(group_rows)
+            return by_serial
+        errors.update(dict.fromkeys(group, detail))
+        return {}
+
+    async def results() -> AsyncIterator[tuple[str, list]]:
+        # The queries start with the body so the leases outlive the endpoint
+        tasks = [asyncio.ensure_future(fetch_group(dbname, group)) for dbname, group in groups.items()]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                for serial, rows in (await finished).items():
+                    yield serial, rows
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(
+        stream_json_object(results(), {"missing": missing}, lambda: {"errors": errors} if errors else {}),
+        media_type="application/json",
+    )
 
 
 @app.get("/v1/sensorunits/data/latest")
@@ -2670,10 +3301,16 @@ async def v1_sensorunits_data_latest(
     offset: Optional[int] = None,
     probenumber: Optional[int] = None,
     sortfield: Optional[str] = None,
+    format: Optional[str] = None,
+    epoch: bool = False,
 ):
-    """List latest sensor readings for a sensor unit."""
+    """List latest sensor readings for a sensor unit.
+
+    Supports ``format=columnar`` and ``epoch=true`` like ``/v1/sensorunits/data``.
+    """
     if not serialnumber:
         raise HTTPException(status_code=400, detail="Missing parameter: needs serialnumber")
+    check_format(format)
     query = (
         "SELECT probenumber, value, timestamp "
         "FROM sensorslatestvalues WHERE serialnumber=?"
@@ -2690,8 +3327,9 @@ async def v1_sensorunits_data_latest(
     if offset is not None:
         query += " OFFSET ?"
         params.append(offset)
-    rows = await db.fetchall(query, tuple(params))
-    return {"result": rows}
+    path = "/v1/sensorunits/data/latest"
+    rows = await db.fetchall(query, tuple(params), records=fast_json(path))
+    return result_response(path, format_rows(rows, format, ["probenumber", "value", "timestamp"], epoch))
 
 
 @app.post("/v1/user/add")
@@ -2704,13 +3342,19 @@ async def v1_user_add(
     """Create a user."""
     if not user_email:
         raise HTTPException(status_code=400, detail="Missing parameter: needs user_email")
-    existing = await db.fetchone("SELECT user_id FROM users WHERE user_email=?", (user_email,))
-    if existing:
+    created = await db.insert_unique(
+        "users",
+        ("user_email",),
+        {
+            "customer_id_ref": customer_id_ref,
+            "user_email": user_email,
+            "user_password": user_password or "",
+            "user_name": user_name or "",
+        },
+    )
+    if not created:
         raise HTTPException(status_code=302, detail="Users email already exists")
-    await db.execute(
-        "INSERT INTO users (customer_id_ref, user_email, user_password, user_name) VALUES (?, ?, ?, ?)",
-        (customer_id_ref, user_email, user_password or "", user_name or ""),
-    )
+    await invalidation.publish("users")
     return {"result": "OK"}
 
 
@@ -2756,6 +3400,7 @@ async def v1_user_update(
     )
     if rowcount == 0:
         raise HTTPException(status_code=404, detail="No record found")
+    await invalidation.publish("users")
     return {"result": "OK"}
 
 
@@ -2767,6 +3412,7 @@ async def v1_user_delete(user_id: Optional[int] = None):
     rowcount = await db.execute("DELETE FROM users WHERE user_id=?", (user_id,))
     if rowcount == 0:
         raise HTTPException(status_code=404, detail=f"No userid for id:{user_id}")
+    await invalidation.publish("users", keys=[str(user_id)])
     return {"message": "OK"}
 
 
@@ -2777,8 +3423,15 @@ async def v1_user_list(
     user_email: Optional[str] = None,
     user_id: Optional[int] = None,
     sortfield: Optional[str] = None,
+    after: Optional[str] = None,
 ):
-    """List users. Lists all users if no filter is set."""
+    """List users. Lists all users if no filter is set.
+
+    Without ``sortfield`` users are ordered by ``user_id`` and a ``next``
+    cursor is returned for use as ``after`` on the following call.
+    """
+    if after and sortfield:
+        raise HTTPException(status_code=400, detail="Parameter after can not be combined with sortfield")
     base_query = (
         "SELECT users.user_id, users.user_name, users.customernumber, users.user_phone_work, users.user_email, "
         "users.user_password, users.user_language, customer.customer_name, customertype.customertype, "
@@ -2796,19 +3449,28 @@ async def v1_user_list(
     if user_id is not None:
         clauses.append("users.user_id=?")
         params.append(user_id)
+    if after:
+        clause, values = keyset_where(["users.user_id"], after, descending=False, types=(int,))
+        clauses.append(clause)
+        params.extend(values)
     query = base_query
     if clauses:
         query += " WHERE " + " AND ".join(clauses)
     if sortfield:
         query += f" ORDER BY {sortfield}"
+    else:
+        query += keyset_order(["users.user_id"], descending=False)
     if limit is not None:
         query += " LIMIT ?"
         params.append(limit)
         if page is not None:
             query += " OFFSET ?"
             params.append(max(page - 1, 0) * limit)
-    rows = await db.fetchall(query, tuple(params))
-    return {"result": rows}
+    path = "/v1/user/list"
+    rows = await db.fetchall(query, tuple(params), records=fast_json(path))
+    if sortfield:
+        return result_response(path, rows)
+    return result_response(path, rows, next=keyset_next(rows, ["user_id"], limit))
 
     
 @app.post("/v1/user/variable/add")
@@ -2820,19 +3482,17 @@ async def v1_user_variable_add(
     """Create a user variable."""
     if user_id is None or variable is None:
         raise HTTPException(status_code=400, detail="Missing parameter: needs user_id and variable")
-    existing = await db.fetchone(
-        "SELECT user_id FROM user_variables WHERE user_id=? AND variable=?",
-        (user_id, variable),
+    created = await db.insert_unique(
+        "user_variables",
+        ("user_id", "variable"),
+        {"user_id": user_id, "variable": variable, "value": value or "0"},
     )
-    if existing:
+    if not created:
         raise HTTPException(
             status_code=302,
             detail=f"Record exists for user_id:{user_id} and variable:{variable}",
         )
-    await db.execute(
-        "INSERT INTO user_variables (user_id, variable, value) VALUES (?, ?, ?)",
-        (user_id, variable, value or "0"),
-    )
+    await invalidation.publish("user_variables")
     return {"result": "OK"}
 
 
@@ -2845,15 +3505,8 @@ async def v1_user_variable_update(
     """Update or create a user variable."""
     if user_id is None or variable is None:
         raise HTTPException(status_code=400, detail="Missing parameter: needs user_id and variable")
-    rowcount = await db.execute(
-        "UPDATE user_variables SET value=? WHERE user_id=? AND variable=?",
-        (value or "0", user_id, variable),
-    )
-    if rowcount == 0:
-        await db.execute(
-            "INSERT INTO user_variables (user_id, variable, value) VALUES (?, ?, ?)",
-            (user_id, variable, value or "0"),
-        )
+    await update_user_variable(user_id, variable, value or "0")
+    await invalidation.publish("user_variables")
     return {"result": "OK"}
 
 
@@ -2880,6 +3533,7 @@ async def v1_user_variable_delete(
     )
     if rowcount == 0:
         raise HTTPException(status_code=404, detail=f"No record for user_id:{user_id}")
+    await invalidation.publish("user_variables")
     return {"result": "OK"}
 
 
@@ -2902,3 +3556,42 @@ async def v1_user_variable_get(
         query += " WHERE " + " AND ".join(clauses)
     rows = await db.fetchall(query, tuple(params))
     return {"result": rows}
+
+
+@app.get("/v1/internal/metrics")
+async def v1_internal_metrics():
+    """Pool saturation metrics in Prometheus text format.
+
+    Reports in-use, idle and maximum connections, requests waiting for a
+    connection, the acquire wait histogram and acquire timeouts for the main
+    pool and every open customer sensordata pool, plus admitted and rejected
+    requests per endpoint class.
+    """
+    pools = [("mainbase", db.pool_stats()), *sensordbs.pool_stats().items()]
+    content = render_pool_metrics(pools) + render_admission_metrics(admission.stats())
+    return Response(content=content, media_type=METRICS_CONTENT_TYPE)
+
+
+@app.get("/v1/internal/metrics/queries")
+async def v1_internal_metrics_queries(reset: Optional[bool] = False):
+    """Per-statement query timings for the main and the sensordata databases.
+
+    Each statement reports count, errors, rows and the pool acquire wait and
+    execution time in milliseconds (total, max and histogram buckets). Pass
+    ``reset=true`` to clear the aggregates after reading them.
+    """
+    result = {
+        "mainbase": db.query_stats.snapshot(),
+        "sensordata": sensordbs.query_stats.snapshot(),
+        "query_cache": db.cache_stats(),
+        "reference_cache": reference_cache.stats(),
+        "sensorunit_index": sensorunit_index.stats(),
+        "user_sensorunits": user_sensorunits.stats(),
+        "sensor_access": sensor_access.stats(),
+        "ingest": ingest.stats() if ingest is not None else None,
+        "spool": sensordata_spool.stats(),
+    }
+    if reset:
+        db.query_stats.reset()
+        sensordbs.query_stats.reset()
+    return {"result": result}